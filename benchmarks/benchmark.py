@@ -0,0 +1,255 @@
+"""
+LePyMo Benchmark module
+
+This module times color matching (with every color difference metric), building mosaic and generating PDF
+on synthetic images and writes the results to a JSON file. Run it from the project directory:
+    python -m benchmarks.benchmark --output results.json
+    python -m benchmarks.benchmark --compare old_results.json results.json
+Images and palettes are generated from fixed seeds, so every run measures the same work.
+Every stage is timed a few times (the fastest run is kept), then traced once for its peak memory.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import datetime
+import tempfile
+import itertools
+import subprocess
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+from PIL import Image
+
+from modules.difference import _METRICS, _DEFAULT_METRIC
+from modules.matcher import find_unique_colors, match_colors
+from modules.mosaic import Mosaic
+from modules.palette import CompiledPalette
+from modules.utilities import closest_pixel, _PDF_FORMATS
+
+_IMAGES = ("gradient", "noise", "flat")
+_SIZES = (32, 64, 128, 256, 512)
+_PALETTE_SIZES = (10, 50, 150, 300)
+_SEED = 2024
+_REPEAT = 3
+# closest_pixel matches pixel by pixel, it's timed on small images only
+_LEGACY_MAX_SIZE = 64
+# stages slower by more than this ratio are reported as regressions
+_REGRESSION_RATIO = 1.1
+
+
+def synthetic_image(kind, size):
+    """Returns a square RGB Pillow image - smooth gradient, random noise or flat photo-like scene"""
+    rng = np.random.default_rng(_SEED + size)
+    if kind == "noise":
+        return Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+
+    y_pos, x_pos = np.mgrid[0:size, 0:size] / max(1, size - 1)
+    if kind == "gradient":
+        pixels = np.stack((x_pos, y_pos, (x_pos + y_pos) / 2), axis=-1) * 255
+        return Image.fromarray(pixels.astype(np.uint8))
+
+    # flat sky and ground, a sun with soft edge and a noisy bush - many identical rows and long runs
+    pixels = np.empty((size, size, 3))
+    pixels[:] = (110, 170, 230)
+    pixels[y_pos > 0.65] = (70, 140, 60)
+    sun = np.hypot(x_pos - 0.7, y_pos - 0.25)
+    pixels[sun < 0.15] = (250, 220, 90) - (sun[sun < 0.15, np.newaxis] * 200)
+    bush = (np.abs(x_pos - 0.25) < 0.12) & (np.abs(y_pos - 0.7) < 0.08)
+    pixels[bush] = rng.integers(20, 90, (int(bush.sum()), 3))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def synthetic_palette(count):
+    """Returns a CompiledPalette of count distinct random colors"""
+    rng = np.random.default_rng(_SEED + count)
+    colors = []
+    while len(colors) < count:
+        color = tuple(int(value) for value in rng.integers(0, 256, 3))
+        if color not in colors:
+            colors.append(color)
+    return CompiledPalette(colors)
+
+
+class StageTimer:  # pylint: disable=R0903
+    """StageTimer class, collects seconds (and peak traced memory) of named stages"""
+
+    def __init__(self, trace=False):
+        """Init StageTimer class"""
+        self.trace = trace
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager, measures the code run inside it"""
+        if self.trace:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        yield
+        self.stages[name] = {"seconds": time.perf_counter() - start}
+        if self.trace:
+            self.stages[name]["peak_bytes"] = tracemalloc.get_traced_memory()[1] - memory_before
+
+
+def run_case(image, palette, timer, options):
+    """Helper function, runs all stages of a single case, returns facts about its result"""
+    # pylint: disable=C0415,R0914
+    from modules.lepymopdf import LePyMoPDF
+    pixels = np.asarray(image)
+    with timer.stage("match"):
+        unique_colors, inverse = find_unique_colors(pixels)
+        indices = match_colors(unique_colors, palette)[inverse].reshape(image.height, image.width)
+
+    # throughput of other metrics, the default one is timed by the match stage
+    for metric in options.metrics:
+        if metric != _DEFAULT_METRIC:
+            with timer.stage(f"match_{metric}"):
+                match_colors(unique_colors, palette, metric=metric)
+
+    if image.width <= options.legacy_max_size:
+        with timer.stage("closest_pixel"):
+            matched = {}
+            for pixel in pixels.reshape(-1, 3).tolist():
+                closest_pixel(tuple(pixel), matched, palette)
+
+    with timer.stage("mosaic"):
+        mosaic = Mosaic(indices, palette.srgb)
+        mosaic.row_counts(0)
+        mosaic.to_image()
+        preview = mosaic.to_preview()
+
+    facts = {"unique_colors": len(unique_colors), "used_colors": int((mosaic.counts() > 0).sum()),
+             "pairs": len(unique_colors) * len(palette)}
+    if options.no_pdf:
+        return facts
+
+    with tempfile.TemporaryDirectory() as directory:
+        pdf_name = os.path.join(directory, "benchmark.pdf")
+        # steps first, then main page, like MosaicJob does
+        with timer.stage("build_step"):
+            pdf = LePyMoPDF(mosaic, None, "benchmark", options.pdf_format)
+            pdf.stream_to(pdf_name)
+            for step in range(mosaic.height):
+                pdf.build_step(step)
+        with timer.stage("main_page"):
+            pdf.add_memory_image(pdf.image_scaled, preview)
+            pdf.main_page()
+        facts["pages"] = pdf.page
+        with timer.stage("output"):
+            pdf.output(pdf_name, "F")
+        facts["pdf_bytes"] = os.path.getsize(pdf_name)
+    return facts
+
+
+def run_benchmark(options):
+    """Runs every case, returns results"""
+    results = {
+        "version": git_version(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "repeat": options.repeat,
+        "pdf_format": options.pdf_format,
+        "cases": [],
+    }
+    for kind, size, palette_size in itertools.product(options.images, options.sizes, options.palettes):
+        image = synthetic_image(kind, size)
+        palette = synthetic_palette(palette_size)
+        stages = {}
+        for _ in range(options.repeat):
+            timer = StageTimer()
+            facts = run_case(image, palette, timer, options)
+            for name, measured in timer.stages.items():
+                stages[name] = min(stages.get(name, measured), measured, key=lambda value: value["seconds"])
+
+        tracemalloc.start()
+        timer = StageTimer(trace=True)
+        run_case(image, palette, timer, options)
+        tracemalloc.stop()
+        for name, measured in timer.stages.items():
+            stages[name]["peak_bytes"] = measured["peak_bytes"]
+
+        case = {"image": kind, "size": size, "palette": palette_size, **facts, "stages": stages}
+        # compared (color, palette color) pairs per second
+        case["throughput"] = {metric: facts["pairs"] / max(stages[name]["seconds"], 1e-9)
+                              for metric, name in metric_stages(options.metrics)}
+        results["cases"].append(case)
+        print(f"{kind:<9} {size:>4}px {palette_size:>4} colors  "
+              + "  ".join(f"{name} {measured['seconds']:.3f}s" for name, measured in stages.items()), file=sys.stderr)
+    return results
+
+
+def metric_stages(metrics):
+    """Helper function, returns (metric, stage name) of every timed metric"""
+    return [(metric, "match" if metric == _DEFAULT_METRIC else f"match_{metric}") for metric in metrics]
+
+
+def git_version():
+    """Helper function, returns current git commit, None outside of a repository"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path, ratio=_REGRESSION_RATIO):
+    """Prints time ratio of every stage in both results, returns amount of stages slower than ratio"""
+    with open(old_path, encoding="utf-8") as old_file, open(new_path, encoding="utf-8") as new_file:
+        old_results, new_results = json.load(old_file), json.load(new_file)
+    old_cases = {(case["image"], case["size"], case["palette"]): case for case in old_results["cases"]}
+    print(f"{old_results['version']} -> {new_results['version']}")
+    regressions = 0
+    for case in new_results["cases"]:
+        old_case = old_cases.get((case["image"], case["size"], case["palette"]))
+        if old_case is None:
+            continue
+        for name, measured in case["stages"].items():
+            if name not in old_case["stages"]:
+                continue
+            change = measured["seconds"] / max(old_case["stages"][name]["seconds"], 1e-9)
+            slower = change > ratio
+            regressions += slower
+            print(f"{case['image']:<9} {case['size']:>4}px {case['palette']:>4} colors {name:<14}"
+                  f"{old_case['stages'][name]['seconds']:>9.3f}s {measured['seconds']:>9.3f}s {change:>7.2f}x"
+                  + ("  slower" if slower else ""))
+    return regressions
+
+
+def parse_args(argv):
+    """Helper function, parses command line arguments"""
+    parser = argparse.ArgumentParser(prog="benchmark", description="Times LePyMo on synthetic images.")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--images", nargs="+", default=_IMAGES, choices=_IMAGES)
+    parser.add_argument("--sizes", nargs="+", type=int, default=_SIZES, help="image sizes (square, in pixels)")
+    parser.add_argument("--palettes", nargs="+", type=int, default=_PALETTE_SIZES, help="palette sizes")
+    parser.add_argument("--repeat", type=int, default=_REPEAT, help="timed runs of every case")
+    parser.add_argument("--metrics", nargs="+", default=list(_METRICS.keys()), choices=list(_METRICS.keys()),
+                        help="color difference metrics timed by matching")
+    parser.add_argument("--pdf-format", default="A4", choices=sorted(_PDF_FORMATS.keys()))
+    parser.add_argument("--no-pdf", action="store_true", help="skip PDF stages")
+    parser.add_argument("--legacy-max-size", type=int, default=_LEGACY_MAX_SIZE,
+                        help="largest image matched with closest_pixel too")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files instead")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Runs benchmark or compares results, returns exit code"""
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    if options.compare:
+        return 1 if compare(*options.compare) else 0
+
+    results = run_benchmark(options)
+    with open(options.output, "w", encoding="utf-8") as output_file:
+        json.dump(results, output_file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,23 @@
 """
 LePyMo Main module
 
-This module runs the main loop.
+This module runs the main loop, or command line interface when any arguments are given
+(python -m lepymo --help).
 """
-import wx
-from modules.lepymoframe import LePyMoFrame
+import sys
+import multiprocessing
 
 
 if __name__ == "__main__":
+    # matching pool processes have to work in frozen executable too
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        # wx isn't needed (nor installed) on headless machines
+        from modules.cli import main
+        sys.exit(main())
+
+    import wx
+    from modules.lepymoframe import LePyMoFrame  # pylint: disable=C0412
     app = wx.App(False)
     frame = LePyMoFrame().Show()
     app.MainLoop()
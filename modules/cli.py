@@ -0,0 +1,183 @@
+"""
+LePyMo CLI module
+
+This module runs LePyMo without GUI, for many images at once, e.g.:
+    python -m lepymo "photos/*.png" --palette example_colors.csv --pdf-format A5 --output-dir mosaics
+All jobs share the compiled palette, match cache and matching processes.
+"""
+
+import os
+import sys
+import csv
+import glob
+import time
+import pathlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from modules.lut import ColorLUT
+from modules.matcher import MatchPool
+from modules.matchcache import MatchCache
+from modules.jobcache import JobCache
+from modules.mosaicjob import MosaicJob
+from modules.palette import CompiledPalette
+from modules.quantize import _QUANTIZE_METHODS, _DEFAULT_QUANTIZE_METHOD
+from modules.utilities import read_palette_csv, _PDF_FORMATS
+from modules.difference import _METRICS, _DEFAULT_METRIC
+
+_DEFAULT_JOBS = 2
+
+
+def parse_args(argv):
+    """Helper function, parses command line arguments"""
+    parser = argparse.ArgumentParser(prog="lepymo", description="Generates mosaic images and building instructions "
+                                                                "of many images without GUI.")
+    parser.add_argument("images", help='image file or glob pattern, e.g. "photos/*.png" (quoted)')
+    parser.add_argument("-p", "--palette", required=True, help="CSV file with palette colors")
+    parser.add_argument("-f", "--pdf-format", default="A4", choices=sorted(_PDF_FORMATS.keys()))
+    parser.add_argument("-o", "--output-dir", default=".", help="directory for generated files")
+    parser.add_argument("--no-pdf", action="store_true", help="generate images only")
+    parser.add_argument("-m", "--metric", default=_DEFAULT_METRIC, choices=list(_METRICS.keys()),
+                        help="color difference used for matching")
+    parser.add_argument("-q", "--quantize", type=int,
+                        help="reduce image to this amount of colors (2 - 256) before matching, the report shows the error")
+    parser.add_argument("--quantize-method", default=_DEFAULT_QUANTIZE_METHOD, choices=list(_QUANTIZE_METHODS.keys()))
+    parser.add_argument("-j", "--jobs", type=int, default=_DEFAULT_JOBS, help="images generated at once")
+    parser.add_argument("--workers", type=int, help="color matching processes, shared by all jobs")
+    parser.add_argument("--pdf-workers", type=int, help="processes building PDF steps of every job")
+    parser.add_argument("--strip-height", type=int, help="match image in strips of rows, mosaic PNG is written on the fly; "
+                        "uncompressed BMP, PPM, TGA and TIFF images are read strip by strip, other formats are decoded whole")
+    parser.add_argument("--lut-size", type=int, help="match colors with a lookup table of this size per channel")
+    parser.add_argument("--no-cache", action="store_true", help="don't use colors and files generated in previous runs")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print progress and stage times of every job")
+    return parser.parse_args(argv)
+
+
+def output_prefixes(image_paths, output_dir):
+    """Helper function, returns output file prefix of every image, images with the same name get numbered"""
+    prefixes = []
+    used = set()
+    for image_path in image_paths:
+        stem = pathlib.Path(image_path).stem
+        prefix, number = stem, 1
+        while prefix in used:
+            number += 1
+            prefix = f"{stem}_{number}"
+        used.add(prefix)
+        prefixes.append(os.path.join(output_dir, prefix))
+    return prefixes
+
+
+def run_job(job):
+    """Helper function, runs a job and returns (result, seconds)"""
+    start = time.perf_counter()
+    result = job.run()
+    return result, time.perf_counter() - start
+
+
+def print_progress(image_path):
+    """Helper function, returns job callback which prints its status changes"""
+    def notify(event_data):
+        if event_data["event_type"] == "status_change":
+            print(f"{image_path}: {event_data['status']}", file=sys.stderr)
+    return notify
+
+
+def print_report(image_path):
+    """Helper function, returns job report hook which prints time of every stage"""
+    def report_hook(report):
+        stages = report["stages"]
+        print(f"{image_path}: " + ", ".join(f"{name} {stage['wall_seconds']:.2f} s" for name, stage in stages.items()),
+              file=sys.stderr)
+        if "quantize" in report:
+            quantize = report["quantize"]
+            print(f"{image_path}: {quantize['source_colors']} -> {quantize['colors']} colors, "
+                  f"mean added difference {quantize['mean_delta_e']:.2f} (max {quantize['max_delta_e']:.2f}), "
+                  f"{100 * quantize['mismatch_rate']:.1f}% pixels changed, "
+                  f"about {quantize['estimated_seconds_saved']:.1f} s saved", file=sys.stderr)
+    return report_hook
+
+
+def run_batch(args):  # pylint: disable=R0912,R0914,R0915
+    """Generates every image matching the pattern, returns exit code"""
+    image_paths = sorted(path for path in glob.glob(args.images, recursive=True) if os.path.isfile(path))
+    if not image_paths:
+        print(f"No images match {args.images}", file=sys.stderr)
+        return 2
+    try:
+        colors = read_palette_csv(args.palette)
+    except OSError as error:
+        print(f"Unable to open CSV file: {error}", file=sys.stderr)
+        return 2
+    except (ValueError, csv.Error) as error:
+        # UnicodeDecodeError is a ValueError too
+        print(f"Unable to read CSV file {args.palette}: {error}", file=sys.stderr)
+        return 2
+    if not colors:
+        print("Color palette is empty.", file=sys.stderr)
+        return 2
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    palette = CompiledPalette(colors)
+    match_cache = None if args.no_cache else MatchCache()
+    job_cache = None if args.no_cache else JobCache()
+    lut = None
+    if args.lut_size:
+        lut = ColorLUT(palette, args.lut_size, metric=args.metric)
+        if not lut.load():
+            print("Building color table", file=sys.stderr)
+            lut.build(args.workers)
+            lut.save()
+            print(f"Color table {lut.size}^3 ({lut.nbytes // 1024} KB) built in {lut.build_time:.1f} s", file=sys.stderr)
+        else:
+            print(f"Color table {lut.size}^3 ({lut.nbytes // 1024} KB) loaded from {lut.path}", file=sys.stderr)
+    match_pool = None
+    if lut is None and (args.workers or os.cpu_count() or 1) > 1:
+        match_pool = MatchPool(palette, args.workers)
+
+    jobs = [MosaicJob(image_path, palette, args.no_pdf, args.pdf_format,
+                      notify=print_progress(image_path) if args.verbose else None, output_prefix=prefix,
+                      workers=args.workers, match_cache=match_cache, strip_height=args.strip_height,
+                      pdf_workers=args.pdf_workers, lut=lut, match_pool=match_pool,
+                      report_hook=print_report(image_path) if args.verbose else None, job_cache=job_cache,
+                      metric=args.metric, quantize=args.quantize, quantize_method=args.quantize_method)
+            for image_path, prefix in zip(image_paths, output_prefixes(image_paths, args.output_dir))]
+    timings = {}
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(1, args.jobs))
+    try:
+        futures = {executor.submit(run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            timings[job] = future.result()
+            print(f"[{len(timings)}/{len(jobs)}] {job.image_path}: "
+                  f"{'done' if timings[job][0] else 'failed'} in {timings[job][1]:.1f} s")
+            for line in job.summary:
+                print(f"    {line}")
+    except KeyboardInterrupt:
+        print("Aborting, files of unfinished images are removed", file=sys.stderr)
+        executor.shutdown(wait=False, cancel_futures=True)
+        for job in jobs:
+            if job not in timings:
+                job.abort()
+        return 130
+    finally:
+        executor.shutdown(wait=True)
+        if match_pool is not None:
+            match_pool.close()
+        if match_cache is not None:
+            match_cache.close()
+
+    print()
+    print(f"{'Image':<40} {'Result':<8} {'Seconds':>7}")
+    for job in jobs:
+        result, seconds = timings[job]
+        print(f"{job.image_path:<40.40} {'done' if result else 'failed':<8} {seconds:>7.1f}")
+    succeeded = sum(1 for result, _ in timings.values() if result)
+    print(f"Finished {succeeded} / {len(jobs)} images in {time.perf_counter() - start:.1f} s")
+    return 0 if succeeded == len(jobs) else 1
+
+
+def main(argv=None):
+    """Runs command line interface, returns exit code"""
+    return run_batch(parse_args(sys.argv[1:] if argv is None else argv))
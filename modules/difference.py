@@ -0,0 +1,73 @@
+"""
+LePyMo Difference module
+
+This module contains color difference functions and the registry of metrics used by matching.
+Every metric compares colors in its own space - CIE Lab or sRGB (0 - 255), arrays are broadcast like in numpy.
+colour-science is imported on the first call only, it takes longer to import than the rest of LePyMo,
+and processes which don't compare colors (GUI start, PDF workers) never need it.
+"""
+
+import numpy as np
+
+# CIE94 constants for graphic arts
+_CIE94_K1 = 0.045
+_CIE94_K2 = 0.015
+
+
+def delta_e_2000(lab_1, lab_2):
+    """Returns CIEDE2000 difference of Lab colors"""
+    from colour.difference import delta_E_CIE2000  # pylint: disable=C0415
+    return delta_E_CIE2000(lab_1, lab_2)
+
+
+def delta_e_94(lab_1, lab_2):
+    """Returns CIE94 (graphic arts) difference of Lab colors, lab_1 is the reference color"""
+    lab_1, lab_2 = np.asarray(lab_1, dtype=np.float64), np.asarray(lab_2, dtype=np.float64)
+    delta = lab_1 - lab_2
+    chroma_1 = np.hypot(lab_1[..., 1], lab_1[..., 2])
+    delta_chroma = chroma_1 - np.hypot(lab_2[..., 1], lab_2[..., 2])
+    delta_hue_squared = np.maximum(delta[..., 1] ** 2 + delta[..., 2] ** 2 - delta_chroma ** 2, 0)
+    return np.sqrt(delta[..., 0] ** 2 + (delta_chroma / (1 + _CIE94_K1 * chroma_1)) ** 2
+                   + delta_hue_squared / (1 + _CIE94_K2 * chroma_1) ** 2)
+
+
+def _euclidean(colors_1, colors_2):
+    """Helper function, returns Euclidean distance of colors (summing channels one by one is faster than sum())"""
+    delta = np.asarray(colors_1, dtype=np.float64) - np.asarray(colors_2, dtype=np.float64)
+    return np.sqrt(delta[..., 0] ** 2 + delta[..., 1] ** 2 + delta[..., 2] ** 2)
+
+
+def delta_e_76(lab_1, lab_2):
+    """Returns CIE76 (Euclidean) difference of Lab colors"""
+    return _euclidean(lab_1, lab_2)
+
+
+def redmean(rgb_1, rgb_2):
+    """Returns redmean difference of sRGB colors - Euclidean with weights depending on the mean red"""
+    rgb_1, rgb_2 = np.asarray(rgb_1, dtype=np.float64), np.asarray(rgb_2, dtype=np.float64)
+    mean_red = (rgb_1[..., 0] + rgb_2[..., 0]) / 2
+    delta = rgb_1 - rgb_2
+    return np.sqrt((2 + mean_red / 256) * delta[..., 0] ** 2 + 4 * delta[..., 1] ** 2
+                   + (2 + (255 - mean_red) / 256) * delta[..., 2] ** 2)
+
+
+def euclidean_rgb(rgb_1, rgb_2):
+    """Returns Euclidean difference of sRGB colors"""
+    return _euclidean(rgb_1, rgb_2)
+
+
+# name of the color difference used by default, caches are keyed by metric names
+_DEFAULT_METRIC = "ciede2000"
+
+_METRICS = {
+    "ciede2000": {"label": "CIEDE2000", "space": "lab", "function": delta_e_2000},
+    "cie94": {"label": "CIE94", "space": "lab", "function": delta_e_94},
+    "cie76": {"label": "CIE76", "space": "lab", "function": delta_e_76},
+    "redmean": {"label": "Redmean (RGB)", "space": "srgb", "function": redmean},
+    "euclidean": {"label": "Euclidean RGB", "space": "srgb", "function": euclidean_rgb},
+}
+
+
+def color_difference(colors_1, colors_2, metric=_DEFAULT_METRIC):
+    """Returns difference of colors given in the space of the metric"""
+    return _METRICS[metric]["function"](colors_1, colors_2)
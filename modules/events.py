@@ -0,0 +1,22 @@
+"""
+LePyMo Events module
+
+This module contains wx event used to send WorkerThread results to the window.
+"""
+
+import wx
+
+
+def event_result(window, function, event_id):
+    """Define Result Event."""
+    window.Connect(-1, -1, event_id, function)
+
+
+class ResultEvent(wx.PyEvent):  # pylint: disable=R0903
+    """Simple event to send thread results"""
+
+    def __init__(self, event_id, data):
+        """Init Result Event."""
+        wx.PyEvent.__init__(self)
+        self.SetEventType(event_id)
+        self.data = data
@@ -0,0 +1,176 @@
+"""
+LePyMo JobCache module
+
+This module contains JobCache and PendingIndices classes.
+JobCache keeps files of finished jobs, keyed by cache version, image pixels, palette fingerprint, metric and lookup table size.
+A repeated job copies cached files instead of generating them, a job with another PDF format reuses matched mosaic.
+Every entry is a directory, least recently used ones are removed when the cache grows over its size limit.
+"""
+
+import os
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+from modules.streaming import iter_image_strips
+from modules.utilities import _CACHE_DIR
+
+_JOB_CACHE_SIZE = 2 * 1024 ** 3
+# part of every key, bump it when matching, PDF steps or layout change - older entries are never used again
+_JOB_CACHE_VERSION = 1
+_INDICES_NAME = "indices.npy"
+# cached file names and suffixes of job files they're copied to
+_IMAGE_FILES = {"mosaic.png": "_mosaic.png", "mosaic_scaled.png": "_mosaic_scaled.png"}
+_PDF_SUFFIX = "_mosaic_instructions.pdf"
+
+
+class PendingIndices:
+    """
+    PendingIndices class, palette indices of a job written to a .npy file strip by strip.
+    The file isn't memory-mapped, so it can be renamed or removed (on Windows too) as soon as it's closed.
+    """
+
+    def __init__(self, path, shape, dtype):
+        """Init PendingIndices class"""
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.rows_written = 0
+        self._file = open(path, "wb")  # pylint: disable=R1732
+        np.lib.format.write_array_header_1_0(self._file, {"descr": np.lib.format.dtype_to_descr(self.dtype),
+                                                          "fortran_order": False, "shape": self.shape})
+
+    def write_rows(self, rows):
+        """Appends (rows, width) array of palette indices, rows come from top to bottom"""
+        self._file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.rows_written += len(rows)
+
+    def close(self):
+        """Closes the file, returns True when all rows are written"""
+        self._file.close()
+        return self.rows_written == self.shape[0]
+
+
+class JobCache:
+    """JobCache class, files of finished jobs on disk with size-bounded LRU eviction"""
+
+    def __init__(self, max_bytes=_JOB_CACHE_SIZE, path=None):
+        """Init JobCache class"""
+        self.max_bytes = max_bytes
+        self.path = path or _CACHE_DIR / "jobs"
+        self.hits = 0
+        self.mosaic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(image, palette, metric, lut_size=None):
+        """Returns key of a job - hash of cache version, image pixels, palette fingerprint, metric and lookup table size"""
+        digest = hashlib.sha1(f"{_JOB_CACHE_VERSION}:{image.size}:{palette.fingerprint}:{metric}:{lut_size}".encode())
+        for _, strip in iter_image_strips(image):
+            digest.update(strip.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _files(pdf_format):
+        """Helper function, returns cached file names and job file suffixes of a job"""
+        files = dict(_IMAGE_FILES)
+        if pdf_format is not None:
+            files[f"{pdf_format}.pdf"] = _PDF_SUFFIX
+        return files
+
+    def restore(self, key, output_prefix, pdf_format=None):
+        """Copies cached files of a job to output_prefix + suffix, returns False when some of them aren't cached"""
+        entry = self.path / key
+        files = self._files(pdf_format)
+        with self._lock:
+            if not all((entry / name).is_file() for name in files):
+                self.misses += 1
+                return False
+            try:
+                for name, suffix in files.items():
+                    shutil.copyfile(entry / name, output_prefix + suffix)
+                os.utime(entry)
+            except OSError:
+                self.misses += 1
+                return False
+            self.hits += 1
+        return True
+
+    def load_indices(self, key):
+        """Returns cached palette indices of a job (memory-mapped), None when they aren't cached"""
+        with self._lock:
+            try:
+                indices = np.load(self.path / key / _INDICES_NAME, mmap_mode="r")
+                os.utime(self.path / key)
+            except (OSError, ValueError):
+                return None
+            self.mosaic_hits += 1
+        return indices
+
+    def new_indices(self, key, shape, dtype):
+        """Returns PendingIndices for palette indices of a job written strip by strip, store() adds them to the cache"""
+        entry = self.path / key
+        entry.mkdir(parents=True, exist_ok=True)
+        return PendingIndices(entry / f"indices_{os.getpid()}_{threading.get_ident()}.tmp", shape, dtype)
+
+    def discard(self, indices):
+        """Removes PendingIndices which weren't stored, and their entry when it's empty"""
+        indices.close()
+        try:
+            os.remove(indices.path)
+            os.rmdir(indices.path.parent)
+        except OSError:
+            pass
+
+    def store(self, key, output_prefix, indices=None, pdf_format=None):
+        """Adds files of a finished job (and its palette indices) to the cache, then evicts old entries"""
+        entry = self.path / key
+        with self._lock:
+            try:
+                entry.mkdir(parents=True, exist_ok=True)
+                # every file is complete before it gets its name, other processes may read the cache
+                if isinstance(indices, PendingIndices):
+                    if indices.close():
+                        os.replace(indices.path, entry / _INDICES_NAME)
+                    else:
+                        os.remove(indices.path)
+                elif indices is not None:
+                    with open(entry / (_INDICES_NAME + ".tmp"), "wb") as indices_file:
+                        np.save(indices_file, indices)
+                    os.replace(entry / (_INDICES_NAME + ".tmp"), entry / _INDICES_NAME)
+                for name, suffix in self._files(pdf_format).items():
+                    shutil.copyfile(output_prefix + suffix, entry / (name + ".tmp"))
+                    os.replace(entry / (name + ".tmp"), entry / name)
+            except OSError:
+                shutil.rmtree(entry, ignore_errors=True)
+                return
+            self._evict()
+
+    def _evict(self):
+        """Helper function, removes least recently used entries until the cache fits its size limit"""
+        entries = []
+        for entry in self.path.iterdir():
+            try:
+                entries.append((entry.stat().st_mtime, sum(file.stat().st_size for file in entry.iterdir()), entry))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        """Returns cache counters"""
+        return {
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "mosaic_hits": self.mosaic_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
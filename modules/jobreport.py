@@ -0,0 +1,54 @@
+"""
+LePyMo JobReport module
+
+This module contains JobReport class.
+JobReport collects wall and CPU time of job stages and job counters, MosaicJob writes it as JSON next to its files.
+Stages may run in many threads at once (matching, PDF steps, PNG encoding), their times are added up.
+CPU time is measured in the thread which runs the stage, work of pool processes isn't included.
+"""
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class JobReport:
+    """JobReport class, times of job stages and job counters"""
+
+    def __init__(self):
+        """Init JobReport class"""
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager, adds wall and CPU time of the code run inside it to a stage"""
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+            with self._lock:
+                stage = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+                stage["wall_seconds"] += wall
+                stage["cpu_seconds"] += cpu
+                stage["calls"] += 1
+
+    def add(self, name, value=1):
+        """Adds value to a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self):
+        """Returns stages and counters"""
+        with self._lock:
+            return {"stages": {name: dict(stage) for name, stage in self.stages.items()},
+                    "counters": dict(self.counters)}
+
+    @staticmethod
+    def save(report, filename):
+        """Writes a report dict as JSON file"""
+        with open(filename, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
@@ -9,17 +9,27 @@ import datetime
 import csv
 import wx
 import wx.lib.scrolledpanel as scrolled
-from modules.utilities import event_result, validate_color, validate_hex_color, convert_hex_to_rgb, _PDF_FORMATS
+from modules.utilities import validate_color, read_palette_csv, _PDF_FORMATS
+from modules.difference import _METRICS, _DEFAULT_METRIC
+from modules.events import event_result, ResultEvent
 from modules.workerthread import WorkerThread
+from modules.matchcache import MatchCache
+from modules.jobcache import JobCache
+from modules.remapper import PaletteRemapper
+from modules.livepreview import LivePreview
+from modules.quantize import _MAX_QUANTIZE_COLORS
 
+# width and height of the preview area
+_PREVIEW_SIZE = 220
 
-class LePyMoFrame(wx.Frame):
+
+class LePyMoFrame(wx.Frame):  # pylint: disable=R0904
     """LePyMo main frame class"""
 
-    # pylint: disable=R0902,R0915
+    # pylint: disable=R0902,R0914,R0915
     def __init__(self):
         """Init LePyMo Class."""
-        wx.Frame.__init__(self, None, wx.ID_ANY, "LePyMo", size=(240, 600))
+        wx.Frame.__init__(self, None, wx.ID_ANY, "LePyMo", size=(240, 910))
 
         self.panel = wx.Panel(self, wx.ID_ANY)
         self.selected_file = ""
@@ -28,6 +38,13 @@ class LePyMoFrame(wx.Frame):
         self.event_id = wx.ID_ANY
         self.input_ids = []
         self.worker = None
+        # caches in ~/.lepymo can be turned off in File menu, the choice is kept in wx.Config
+        self.config = wx.Config("LePyMo")
+        self.use_cache = self.config.ReadBool("UseCache", True)
+        # palette is edited between runs, colors of the previous run are remapped instead of matched again
+        self.match_cache = PaletteRemapper(MatchCache() if self.use_cache else None)
+        self.job_cache = JobCache() if self.use_cache else None
+        self.live_preview = LivePreview(self.post_preview, self.match_cache)
         self.version = (0, 0, 0, 4)
 
         event_result(self, self.on_result, self.event_id)
@@ -44,6 +61,7 @@ class LePyMoFrame(wx.Frame):
         self.generate_sizer = wx.BoxSizer(wx.VERTICAL)
         self.buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
         self.status_sizer = wx.BoxSizer(wx.VERTICAL)
+        self.preview_sizer = wx.BoxSizer(wx.VERTICAL)
 
         self.scrolled_panel.SetSizer(self.palette_sizer)
 
@@ -112,6 +130,17 @@ class LePyMoFrame(wx.Frame):
                                             label="(Use this option to test\n "
                                             "your color palette.)", name="colorPalette")
 
+        metric_label = wx.StaticText(self.panel, wx.ID_ANY, label="Color difference:", name="metricLabel")
+        self.metric_choice = wx.Choice(self.panel, wx.ID_ANY, choices=[metric["label"] for metric in _METRICS.values()])
+        self.metric_choice.SetSelection(list(_METRICS.keys()).index(_DEFAULT_METRIC))
+        self.metric_choice.Bind(wx.EVT_CHOICE, self.on_metric_change)
+        self.input_ids.append(self.metric_choice.GetId())
+
+        quantize_label = wx.StaticText(self.panel, wx.ID_ANY, label="Reduce image to colors\n(0 - keep all colors):",
+                                       name="quantizeLabel")
+        self.quantize_spin = wx.SpinCtrl(self.panel, wx.ID_ANY, min=0, max=_MAX_QUANTIZE_COLORS, initial=0)
+        self.input_ids.append(self.quantize_spin.GetId())
+
         pdf_formats = sorted(_PDF_FORMATS.keys())
         self.pdf_format_radio_box = wx.RadioBox(self.panel, id=wx.ID_ANY, label="PDF Format",
                                                 choices=pdf_formats, name="pdfFormatRadioBox")
@@ -123,6 +152,12 @@ class LePyMoFrame(wx.Frame):
         self.generate_sizer.Add(self.nopdf_checkbox)
         self.generate_sizer.Add(nopdf_checkbox_info)
         self.generate_sizer.AddSpacer(10)
+        self.generate_sizer.Add(metric_label)
+        self.generate_sizer.Add(self.metric_choice)
+        self.generate_sizer.AddSpacer(10)
+        self.generate_sizer.Add(quantize_label)
+        self.generate_sizer.Add(self.quantize_spin)
+        self.generate_sizer.AddSpacer(10)
         self.generate_sizer.Add(self.pdf_format_radio_box)
         self.generate_sizer.AddSpacer(10)
         self.generate_sizer.Add(generate_btn)
@@ -139,6 +174,11 @@ class LePyMoFrame(wx.Frame):
                                            label='Status: Idle', name="lepymoStatus")
         self.status_sizer.Add(self.lepymo_status)
 
+        self.preview_label = wx.StaticText(self.panel, wx.ID_ANY, label="Preview:", name="previewLabel")
+        self.preview_bitmap = wx.StaticBitmap(self.panel, wx.ID_ANY)
+        self.preview_sizer.Add(self.preview_label)
+        self.preview_sizer.Add(self.preview_bitmap)
+
         panel_sizer = wx.BoxSizer(wx.VERTICAL)
 
         panel_sizer.Add(self.file_sizer, 0, wx.ALIGN_LEFT)
@@ -153,12 +193,17 @@ class LePyMoFrame(wx.Frame):
         panel_sizer.Add(self.buttons_sizer, 0, wx.ALIGN_LEFT)
         panel_sizer.AddSpacer(30)
         panel_sizer.Add(self.status_sizer, 0, wx.ALIGN_LEFT)
+        panel_sizer.AddSpacer(10)
+        panel_sizer.Add(self.preview_sizer, 0, wx.ALIGN_LEFT)
         panel_sizer.AddSpacer(5)
 
         self.panel.SetSizer(panel_sizer)
 
         file_menu = wx.Menu()
 
+        cache_item = file_menu.AppendCheckItem(-1, "Cache results in ~/.lepymo",
+                                               "Reuse matched colors and files of previous jobs")
+        cache_item.Check(self.use_cache)
         exit_item = file_menu.Append(-1, "Close", "Close program")
 
         help_menu = wx.Menu()
@@ -171,6 +216,7 @@ class LePyMoFrame(wx.Frame):
         self.SetMenuBar(menu_bar)
 
         self.Bind(wx.EVT_MENU, self.on_info, info_item)
+        self.Bind(wx.EVT_MENU, self.on_cache_change, cache_item)
         self.Bind(wx.EVT_MENU, self.on_exit, exit_item)
         self.Bind(wx.EVT_CLOSE, self.on_exit)
 
@@ -190,6 +236,7 @@ class LePyMoFrame(wx.Frame):
             self.add_color_to_palette(color)
             self.scrolled_panel.Layout()
             self.scrolled_panel.SetupScrolling()
+            self.update_preview()
         else:
             wx.MessageBox(message="This color has already been added to the palette.",
                           caption="Color duplicate",
@@ -200,37 +247,42 @@ class LePyMoFrame(wx.Frame):
         self.selected_file = self.file_picker.GetPath()
         select_file_text = "File: " + (self.selected_file if self.selected_file else "Not selected")
         self.select_file_status.SetLabel(select_file_text)
+        self.update_preview()
 
     def on_checkbox_change(self, _):
         """Helper function, changes checkbox value"""
         self.nopdf = not self.nopdf
 
+    def on_cache_change(self, event):
+        """Helper function, turns caches in ~/.lepymo on or off for next jobs and previews"""
+        self.use_cache = event.IsChecked()
+        self.config.WriteBool("UseCache", self.use_cache)
+        self.config.Flush()
+        # running job and preview keep caches they were started with
+        self.match_cache = PaletteRemapper(MatchCache() if self.use_cache else None)
+        self.live_preview.match_cache = self.match_cache
+        self.job_cache = JobCache() if self.use_cache else None
+
+    def on_metric_change(self, _):
+        """Helper function, renders preview with selected color difference"""
+        self.update_preview()
+
+    def selected_metric(self):
+        """Helper function, returns name of selected color difference"""
+        return list(_METRICS.keys())[self.metric_choice.GetSelection()]
+
     def on_colors_load(self, _):
         """Helper function, loads colors from CSV file"""
         csv_file_path = self.csv_file_picker.GetPath()
-        colors = []
         try:
-            with open(csv_file_path, newline='', encoding='utf-8') as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=';', quotechar='|')
-                rows = list(csv_reader)
-
+            colors = read_palette_csv(csv_file_path)
         except:
             wx.MessageBox(message="Loading colors failed",
                           caption="Unable to open CSV file",
                           style=wx.OK | wx.ICON_ERROR)
+            return
 
-        for row in rows:
-            if len(row) == 3:
-                if row[0].startswith('#') and validate_hex_color(row[0]):
-                    color_tuple = convert_hex_to_rgb(row[0].lstrip('#'))
-                elif not row[0].startswith('#'):
-                    color_tuple = tuple(int(z) for z in row if z.isdigit())
-            else:
-                continue
-            if len(color_tuple) == 3 and color_tuple not in self.palette.values():
-                colors.append(color_tuple)
-
-        colors = list(set(colors))
+        colors = [color for color in colors if color not in self.palette.values()]
         added_colors = 0
         for color in colors:
             if self.add_color_to_palette(color):
@@ -238,6 +290,7 @@ class LePyMoFrame(wx.Frame):
 
         self.scrolled_panel.Layout()
         self.scrolled_panel.SetupScrolling()
+        self.update_preview()
         wx.MessageBox(message=f"{added_colors} color{'s' if added_colors != 1 else ''} "
                               f"have been added to the palette ",
                       caption="Added colors", style=wx.OK)
@@ -290,6 +343,31 @@ class LePyMoFrame(wx.Frame):
         btn.Destroy()
         self.scrolled_panel.Layout()
         self.scrolled_panel.SetupScrolling()
+        self.update_preview()
+
+    def update_preview(self):
+        """Helper function, renders preview of the current palette in the background"""
+        self.live_preview.update(self.selected_file, list(self.palette.values()), self.selected_metric())
+        if not self.selected_file or not self.palette:
+            self.show_preview(None, True)
+
+    def post_preview(self, event_data):
+        """Helper function, sends preview from LivePreview thread to the window"""
+        wx.PostEvent(self, ResultEvent(self.event_id, event_data))
+
+    def show_preview(self, image, exact):
+        """Helper function, shows preview (Pillow image) scaled to the preview area"""
+        if image is None:
+            self.preview_bitmap.SetBitmap(wx.NullBitmap)
+            self.preview_label.SetLabel("Preview:")
+        else:
+            scale = min(_PREVIEW_SIZE / image.width, _PREVIEW_SIZE / image.height)
+            # nearest neighbour scaling keeps bricks sharp
+            preview = wx.Image(image.width, image.height, image.tobytes()).Scale(
+                max(1, int(image.width * scale)), max(1, int(image.height * scale)), wx.IMAGE_QUALITY_NORMAL)
+            self.preview_bitmap.SetBitmap(wx.Bitmap(preview))
+            self.preview_label.SetLabel("Preview:" if exact else "Preview: (refining...)")
+        self.panel.Layout()
 
     def on_generate(self, _):
         """Function initiates WorkerThread"""
@@ -311,7 +389,10 @@ class LePyMoFrame(wx.Frame):
             pdf_format = pdf_formats[self.pdf_format_radio_box.GetSelection()]
             self.worker = WorkerThread(self, self.selected_file,
                                        list(self.palette.values()),
-                                       self.nopdf, self.event_id, pdf_format)
+                                       self.nopdf, event_id=self.event_id, pdf_format=pdf_format,
+                                       match_cache=self.match_cache,
+                                       job_cache=self.job_cache, metric=self.selected_metric(),
+                                       quantize=self.quantize_spin.GetValue() or None)
 
     def disable_inputs(self):
         """Helper function, disables inputs"""
@@ -343,14 +424,32 @@ class LePyMoFrame(wx.Frame):
                                   caption="Generating image and pdf failed",
                                   style=wx.OK | wx.ICON_ERROR)
                 else:
-                    wx.MessageBox(message="Finished!", caption="Finished!", style=wx.OK)
+                    message = "Finished!"
+                    if event.data.get("summary"):
+                        message += "\n\n" + event.data["summary"]
+                    wx.MessageBox(message=message, caption="Finished!", style=wx.OK)
 
                 self.worker = None
                 self.enable_inputs()
 
+            elif event.data["event_type"] == "aborted":
+                for filename in event.data["not_removed"]:
+                    error_message = f"LePyMo Was unable to remove {filename}, try to remove it manually."
+                    wx.MessageBox(message=error_message, caption="Removing file failed", style=wx.OK | wx.ICON_ERROR)
+                self.set_status("Idle")
+                if self.worker is not None:
+                    self.worker = None
+                    wx.MessageBox(message="Action aborted.", caption="Action aborted", style=wx.OK)
+                    self.enable_inputs()
+
             elif event.data["event_type"] == "status_change":
                 self.set_status(event.data["status"])
 
+            elif event.data["event_type"] == "preview":
+                # preview of an older palette may arrive after the palette is edited again
+                if event.data["generation"] == self.live_preview.generation:
+                    self.show_preview(event.data["image"], event.data["exact"])
+
     def on_info(self, _):
         """Helper function, shows messagebox"""
         wx.MessageBox(
@@ -371,7 +470,9 @@ class LePyMoFrame(wx.Frame):
                     "few minutes - it depends on amount of colors in your palette and dimensions of image. The PDF "
                     "consists of total bricks amount of each color and building instructions divided in steps - each "
                     "step is one row.\n\nYou can stop current action using Abort button - all files created in "
-                    "current run will be removed. You can clear inputs (source image, color palette, No PDF checkbox) "
+                    "current run will be removed. Matched colors and files of finished jobs are kept in .lepymo "
+                    "folder in your home directory (up to about 2.2 GB), you can turn it off in File menu. You can "
+                    "clear inputs (source image, color palette, No PDF checkbox) "
                     "using Clear button.\n\nHave fun!\n\nLePyMo version: " + ".".join([str(num) for num in self.version]),
             caption="Info",
             style=wx.OK | wx.ICON_INFORMATION)
@@ -391,7 +492,10 @@ class LePyMoFrame(wx.Frame):
             self.select_file_status.SetLabel("Not selected")
             self.nopdf = True
             self.nopdf_checkbox.SetValue(True)
+            self.metric_choice.SetSelection(list(_METRICS.keys()).index(_DEFAULT_METRIC))
+            self.quantize_spin.SetValue(0)
             self.palette_sizer.Layout()
+            self.update_preview()
 
     def on_abort(self, event):
         """Helper function, aborts current action"""
@@ -400,11 +504,9 @@ class LePyMoFrame(wx.Frame):
                                       style=wx.YES_NO, pos=wx.DefaultPosition)
             response = dialog.ShowModal()
             if response == wx.ID_YES and self.worker:
+                # inputs are enabled when the job has stopped and its files are removed, see on_result
+                self.set_status("Aborting")
                 self.worker.abort()
-
-                self.worker = None
-                wx.MessageBox(message="Action aborted.", caption="Action aborted", style=wx.OK)
-                self.enable_inputs()
             else:
                 event.StopPropagation()
         else:
@@ -423,6 +525,7 @@ class LePyMoFrame(wx.Frame):
 
     def exit_program(self, _):
         """Helper function, aborts worker and exits program"""
+        self.live_preview.close()
         if self.worker:
             self.worker.abort()
             self.worker = None
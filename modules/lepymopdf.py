@@ -5,18 +5,58 @@ This module contains LePyMoPDF class.
 LePyMoPDF class is used to generate pdf.
 """
 
-from collections import Counter
+import os
+import math
+import signal
+import zlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from PIL import Image
-from fpdf import FPDF
 
+from modules.mosaic import BrickRows, Mosaic
+from modules.pdfwriter import StreamingFPDF, DEFERRED_MARK
 from modules.utilities import _PDF_FORMATS
 
+# widths of texts for every PDF format, texts like headers and page numbers repeat in every document
+_TEXT_WIDTHS = {pdf_format: {} for pdf_format in _PDF_FORMATS}
+# laid out steps kept for identical rows (least recently used are dropped)
+_STEP_CACHE_SIZE = 256
+# steps built in a process pool are split into ranges, a few for every process so they finish evenly
+_RANGES_PER_WORKER = 4
+_MIN_RANGE_STEPS = 8
+# fewer steps are built in the current process, starting a pool costs more
+_POOL_MIN_STEPS = 256
 
-class LePyMoPDF(FPDF):
+
+def _build_fragment(mosaic, top, first, pdf_format, start_date, brick_colors):  # pylint: disable=R0913
+    """
+    Helper function, builds steps of mosaic rows in a pool process and returns them as a fragment.
+    Mosaic starts at row top, rows before the first step are built as well (and dropped),
+    so the first page starts in the same state as it does when all steps are built in one document.
+    """
+    pdf = LePyMoPDF(mosaic, None, start_date, pdf_format)
+    pdf.add_brick_forms(brick_colors)
+    first_page = 1
+    for step in range(top, top + mosaic.height):
+        if step == first:
+            first_page = pdf.page + 1
+            pdf.step_hits = pdf.step_misses = 0
+        pdf.build_step(step, step - top)
+    return pdf.fragment(first_page)
+
+
+class LePyMoPDF(StreamingFPDF):  # pylint: disable=R0902,R0904
     """LePyMoPDF class"""
 
-    def __init__(self, image_src, image_scaled, start_date, pdf_format):
-        """Init LePyMoPDF class"""
+    def __init__(self, mosaic, image_scaled, start_date, pdf_format):
+        """
+        Init LePyMoPDF class.
+        Mosaic is a Mosaic or MosaicRows (or Pillow image), its scaled preview is a Pillow image (or path to image file).
+        MosaicRows may still be filled while steps are built, then preview is added with add_memory_image() later.
+        Pages are written to a file as they are built after stream_to() is called.
+        """
         if pdf_format not in _PDF_FORMATS.keys():
             pdf_format = "A4"
         super().__init__(format=pdf_format)
@@ -24,15 +64,51 @@ class LePyMoPDF(FPDF):
         self.pdf_format = pdf_format
         self.pdf_width = _PDF_FORMATS[self.pdf_format]["pdf_width"]
         self.pdf_height = _PDF_FORMATS[self.pdf_format]["pdf_height"]
-        self.image_src = Image.open(image_src)
-        self.image_scaled = image_scaled
+        if not isinstance(mosaic, BrickRows):
+            mosaic = Mosaic.from_image(mosaic if isinstance(mosaic, Image.Image) else Image.open(mosaic))
+        self.mosaic = mosaic
+        self.image_scaled = "mosaic_scaled"
+        if image_scaled is not None:
+            self.add_memory_image(self.image_scaled,
+                                  image_scaled if isinstance(image_scaled, Image.Image) else Image.open(image_scaled))
         self.start_date = start_date
-        self.colors = Counter(self.image_src.getdata())
-        self.image_width, self.image_height = self.image_src.size
+        self.image_width, self.image_height = self.mosaic.width, self.mosaic.height
+        self.colors = {}
+        # main page may be built after steps, it's moved to the front when the document is closed
+        self.title_page = None
+        self.page_number_colors = {}
+        # content of step pages below "Step N" header, by runs of the row
+        self.step_cache = OrderedDict()
+        self.step_hits = 0
+        self.step_misses = 0
+        self.recording = None
+        self.recording_start = 0
+
+    def add_memory_image(self, name, image):
+        """Registers an in-memory Pillow image, so it can be placed with image() without any file"""
+        pixels = np.asarray(image.convert("RGB"))
+        # PNG "Up" filter on every row, scaled mosaics repeat rows a lot
+        rows = np.diff(pixels.astype(np.int16), axis=0, prepend=0).astype(np.uint8).reshape(image.height, -1)
+        rows = np.concatenate((np.full((image.height, 1), 2, dtype=np.uint8), rows), axis=1)
+        self.images[name] = {
+            "w": image.width,
+            "h": image.height,
+            "cs": "DeviceRGB",
+            "bpc": 8,
+            "f": "FlateDecode",
+            "dp": f"/Predictor 15 /Colors 3 /BitsPerComponent 8 /Columns {image.width}",
+            "data": zlib.compress(rows.tobytes()),
+            "i": len(self.images) + 1,
+        }
 
     def main_page(self):
         """Generates main page of PDF"""
+        # colors in order of their first appearance, like on the pages
+        compacted = self.mosaic.compact()
+        self.colors = dict(zip(compacted.colors, compacted.counts().tolist()))
+        self.image_width, self.image_height = self.mosaic.width, self.mosaic.height
         self.add_page()
+        self.title_page = self.page
         y_pos = _PDF_FORMATS[self.pdf_format]["page_y_pos"]
         self.big_header("LePyMo", _PDF_FORMATS[self.pdf_format]["deafult_header_margin_top"])
         self.small_header("Lego Python Mosaic", y_pos)
@@ -75,45 +151,49 @@ class LePyMoPDF(FPDF):
 
         self.big_header("Have fun!", y_pos)
 
-    def build_step(self, step):
-        """Generates a single step of the building instructions"""
-        current_row = []
-        img_data = list(self.image_src.getdata())
-        img_data = img_data[step * self.image_width:(step + 1) * self.image_width]
-        for index, value in enumerate(img_data):
-            if self._abort == 1:
-                return
-            if index % self.image_width == 0:
-                current_data = {
-                    "color": value,
-                    "count": 1
-                }
-                current_row.append(current_data)
-            else:
-                current_value = img_data[index - 1]
-                if value == current_value:
-                    current_row[-1]["count"] += 1
-                else:
-                    current_data = {
-                        "color": value,
-                        "count": 1
-                    }
-                    current_row.append(current_data)
-
+    def build_step(self, step, row=None):
+        """
+        Generates a single step of the building instructions, steps of identical rows are copied from the cache.
+        Row of the mosaic is the same as the step, unless it's given.
+        """
         if self._abort == 1:
             return
 
+        row = step if row is None else row
+        run_colors, run_lengths = self.mosaic.row_runs(row)
+        key = (run_colors.tobytes(), run_lengths.tobytes())
         self.add_page()
         self.big_header("Step " + str(step + 1), _PDF_FORMATS[self.pdf_format]["deafult_header_margin_top"])
-        row_colors = Counter(list(self.image_src.getdata())[step * self.image_width:(step + 1) * self.image_width])
+        if key in self.step_cache:
+            self.step_cache.move_to_end(key)
+            self.step_hits += 1
+            self.replay_step(self.step_cache[key])
+            return
+
+        self.step_misses += 1
+        self.recording = []
+        self.recording_start = len(self.pages[self.page])
+        finished = self.step_layout(row, run_colors, run_lengths)
+        segments = self.recording + [self.step_segment()]
+        self.recording = None
+        if finished:
+            self.step_cache[key] = segments
+            if len(self.step_cache) > _STEP_CACHE_SIZE:
+                self.step_cache.popitem(last=False)
+
+    def step_layout(self, row, run_colors, run_lengths):
+        """Helper function, lays out bricks of a step below its header, returns False when aborted"""
+        current_row = zip(run_colors.tolist(), run_lengths.tolist())
+        row_colors = zip(*(values.tolist() for values in self.mosaic.row_counts(row)))
 
         y_pos = _PDF_FORMATS[self.pdf_format]["page_y_pos"] + _PDF_FORMATS[self.pdf_format]["small_header_margin"]
         self.small_header("You'll need in this step:", y_pos)
         y_pos += _PDF_FORMATS[self.pdf_format]["small_header_margin"]
 
-        for color, qty in row_colors.items():
+        for color_index, qty in row_colors:
             if self._abort == 1:
-                return
+                return False
+            color = self.mosaic.colors[color_index]
             if y_pos + _PDF_FORMATS[self.pdf_format]["small_brick_margin"] > _PDF_FORMATS[self.pdf_format]["page_max_y_pos"]:
                 self.add_page()
                 y_pos = _PDF_FORMATS[self.pdf_format]["medium_header_margin"]
@@ -126,65 +206,202 @@ class LePyMoPDF(FPDF):
         self.small_header("Bricks from left to the right:", y_pos)
 
         y_pos += _PDF_FORMATS[self.pdf_format]["small_header_margin"]
-        for current_row_element in current_row:
+        for color_index, count in current_row:
             if self._abort == 1:
-                return
+                return False
+            color = self.mosaic.colors[color_index]
             if y_pos + _PDF_FORMATS[self.pdf_format]["small_brick_margin"] > _PDF_FORMATS[self.pdf_format]["page_max_y_pos"]:
                 self.add_page()
                 y_pos = _PDF_FORMATS[self.pdf_format]["medium_header_margin"]
             self.small_brick(_PDF_FORMATS[self.pdf_format]["small_brick_x_pos"],
-                             y_pos - _PDF_FORMATS[self.pdf_format]["small_brick_margin"] / 2,
-                             current_row_element["color"])
-            self.brick_text(f"x {current_row_element['count']} {str(current_row_element['color'])}",
+                             y_pos - _PDF_FORMATS[self.pdf_format]["small_brick_margin"] / 2, color)
+            self.brick_text(f"x {count} {str(color)}",
                             _PDF_FORMATS[self.pdf_format]["small_brick_text_x_pos"], y_pos)
             y_pos += _PDF_FORMATS[self.pdf_format]["small_brick_margin"]
+        return True
+
+    def step_segment(self):
+        """Helper function, returns content recorded on the current page and the state it leaves"""
+        return self.pages[self.page][self.recording_start:], self.drawing_state()
+
+    def replay_step(self, segments):
+        """Helper function, adds recorded step content, pages are still added (with their footers) one by one"""
+        for number, (content, state) in enumerate(segments):
+            if number:
+                self.add_page()
+            self.pages[self.page] += content
+            self.set_drawing_state(state)
+
+    def step_cache_stats(self):
+        """Returns (reused steps, laid out steps)"""
+        return self.step_hits, self.step_misses
+
+    def iter_parallel_steps(self, workers=None):
+        """
+        Generator, builds steps of all mosaic rows in a process pool and yields amount of built steps.
+        Contiguous ranges of steps are built as fragments and added in order, pages are the same as built one by one.
+        Closing the generator cancels pending ranges.
+        """
+        workers = workers or os.cpu_count() or 1
+        height = self.mosaic.height
+        if workers <= 1 or height < _POOL_MIN_STEPS:
+            for step in range(height):
+                self.build_step(step)
+                yield step + 1
+            return
+
+        size = max(_MIN_RANGE_STEPS, math.ceil(height / (workers * _RANGES_PER_WORKER)))
+        # forms are numbered in order of the first use, like they're when steps are built one by one
+        self.add_brick_forms(self.mosaic.compact().colors)
+        # spawn - forking a process which runs GUI threads isn't safe
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+        try:
+            futures = []
+            for first in range(0, height, size):
+                top = max(first - 1, 0)
+                futures.append((min(first + size, height), executor.submit(
+                    _build_fragment, self.mosaic.rows(top, min(first + size, height)), top, first,
+                    self.pdf_format, self.start_date, list(self.forms))))
+            for last, future in futures:
+                self.add_fragment(future.result())
+                yield last
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def fragment(self, first_page):
+        """Returns pages from first_page on for add_fragment(), with their page number colors and step cache stats"""
+        fragment = super().fragment(first_page)
+        fragment["page_number_colors"] = [self.page_number_colors.get(page) for page in range(first_page, self.page + 1)]
+        fragment["step_stats"] = self.step_cache_stats()
+        return fragment
+
+    def add_fragment(self, fragment):
+        """Adds pages of fragment() after the current page"""
+        first_page = self.page + 1
+        super().add_fragment(fragment)
+        for page, color_flag in enumerate(fragment["page_number_colors"], first_page):
+            if color_flag is not None:
+                self.page_number_colors[page] = color_flag
+        self.step_hits += fragment["step_stats"][0]
+        self.step_misses += fragment["step_stats"][1]
+
+    def add_page(self, orientation=''):
+        """Starts a new page, recorded step content is split at every page break"""
+        if self.recording is not None:
+            self.recording.append(self.step_segment())
+        super().add_page(orientation)
+        self.recording_start = len(self.pages[self.page])
 
     def big_header(self, header_text, from_top):
         """Adds a big header to the current page"""
-        self.set_font('Arial', '', _PDF_FORMATS[self.pdf_format]["big_header_font_size"])
-        self.text((self.pdf_width - self.get_string_width(header_text)) / 2, from_top, header_text)
+        self.use_font("big_header_font_size")
+        self.text((self.pdf_width - self.text_width(header_text)) / 2, from_top, header_text)
 
     def medium_header(self, header_text, from_top):
         """Adds a medium header to the current page"""
-        self.set_font('Arial', '', _PDF_FORMATS[self.pdf_format]["medium_header_font_size"])
-        self.text((self.pdf_width - self.get_string_width(header_text)) / 2, from_top, header_text)
+        self.use_font("medium_header_font_size")
+        self.text((self.pdf_width - self.text_width(header_text)) / 2, from_top, header_text)
 
     def small_header(self, header_text, from_top):
         """Adds a small header to the current page"""
-        self.set_font('Arial', '', _PDF_FORMATS[self.pdf_format]["small_header_font_size"])
-        self.text((self.pdf_width - self.get_string_width(header_text)) / 2, from_top, header_text)
+        self.use_font("small_header_font_size")
+        self.text((self.pdf_width - self.text_width(header_text)) / 2, from_top, header_text)
 
     def footer(self):
         """Adds a small footer to the current page with link to project's Github"""
-        if self.page_no() > 1:
+        if self.page != self.title_page:
             footer_text = "Generated using LePyMo"
-            self.set_font('Arial', '', _PDF_FORMATS[self.pdf_format]["footer_font_size"])
+            self.use_font("footer_font_size")
             self.set_text_color(222, 222, 222)
-            self.text((self.pdf_width - self.get_string_width(footer_text)) / 2,
-                      _PDF_FORMATS[self.pdf_format]["footer_text_y_pos"], footer_text)
-            self.link(x=(self.pdf_width - self.get_string_width(footer_text)) / 2, y=_PDF_FORMATS[self.pdf_format]["footer_link_y"],
-                      w=self.get_string_width(footer_text), h=_PDF_FORMATS[self.pdf_format]["footer_link_height"],
+            footer_width = self.text_width(footer_text)
+            self.text((self.pdf_width - footer_width) / 2, _PDF_FORMATS[self.pdf_format]["footer_text_y_pos"], footer_text)
+            self.link(x=(self.pdf_width - footer_width) / 2, y=_PDF_FORMATS[self.pdf_format]["footer_link_y"],
+                      w=footer_width, h=_PDF_FORMATS[self.pdf_format]["footer_link_height"],
                       link='https://github.com/kjuraszek/lego-python-mosaic/')
             self.set_text_color(0, 0, 0)
-            self.set_font('Arial', '', _PDF_FORMATS[self.pdf_format]["paging_font_size"])
-            current_page = f'- {self.page_no()} -'
-            self.text((self.pdf_width - self.get_string_width(current_page)) / 2,
+            self.use_font("paging_font_size")
+            # page number is known when the document is closed
+            self.page_number_colors[self.page] = self.color_flag
+            self._out(DEFERRED_MARK)
+
+    def page_order(self):
+        """Returns pages in the order they are put in the document, main page goes in front of steps built before it"""
+        order = list(range(1, self.page + 1))
+        if self.title_page:
+            order = order[self.title_page - 1:] + order[:self.title_page - 1]
+        return order
+
+    def deferred_content(self, page, number):
+        """Returns page number of a page, drawn like the rest of its footer"""
+        if page not in self.page_number_colors:
+            return ""
+
+        def draw_page_number():
+            self.set_text_color(0, 0, 0)
+            self.color_flag = self.page_number_colors[page]
+            current_page = f'- {number} -'
+            self.text((self.pdf_width - self.text_width(current_page)) / 2,
                       _PDF_FORMATS[self.pdf_format]["paging_y_pos"], current_page)
 
+        # font has been set in the footer already
+        self.capture(lambda: self.use_font("paging_font_size"))
+        return self.capture(draw_page_number)
+
     def brick_text(self, text, position_x, position_y):
         """Adds a brick text to the page"""
-        self.set_font('Arial', '', _PDF_FORMATS[self.pdf_format]["small_brick_font_size"])
+        self.use_font("small_brick_font_size")
         self.text(position_x, position_y, text)
 
+    def use_font(self, font_size):
+        """Selects Arial in a size from the PDF format, unless it's already selected"""
+        size = _PDF_FORMATS[self.pdf_format][font_size]
+        if self.font_family != "helvetica" or self.font_style or self.font_size_pt != size:
+            self.set_font('Arial', '', size)
+
+    def text_width(self, text):
+        """Returns width of a text in the current font, widths are cached per PDF format"""
+        key = (self.font_size_pt, text)
+        widths = _TEXT_WIDTHS[self.pdf_format]
+        if key not in widths:
+            widths[key] = self.get_string_width(text)
+        return widths[key]
+
+    def brick_swatch(self, color):
+        """Returns PDF operators which draw a brick from its top left corner, in points"""
+        size = _PDF_FORMATS[self.pdf_format]["small_brick_size"] * self.k
+        radius = _PDF_FORMATS[self.pdf_format]["small_brick_ellipsis_size"] * self.k / 2
+        center_x = _PDF_FORMATS[self.pdf_format]["small_brick_ellipsis_pos"] * self.k + radius
+        center_y = -center_x
+        # the same Bezier curves as FPDF.ellipse()
+        arc = 4 / 3 * (math.sqrt(2) - 1) * radius
+        red, green, blue = (value / 255 for value in color)
+        return "\n".join((
+            f"{red:.3f} {green:.3f} {blue:.3f} rg",
+            f"0.00 0.00 {size:.2f} {-size:.2f} re B",
+            f"{center_x + radius:.2f} {center_y:.2f} m {center_x + radius:.2f} {center_y + arc:.2f} "
+            f"{center_x + arc:.2f} {center_y + radius:.2f} {center_x:.2f} {center_y + radius:.2f} c",
+            f"{center_x - arc:.2f} {center_y + radius:.2f} {center_x - radius:.2f} {center_y + arc:.2f} "
+            f"{center_x - radius:.2f} {center_y:.2f} c",
+            f"{center_x - radius:.2f} {center_y - arc:.2f} {center_x - arc:.2f} {center_y - radius:.2f} "
+            f"{center_x:.2f} {center_y - radius:.2f} c",
+            f"{center_x + arc:.2f} {center_y - radius:.2f} {center_x + radius:.2f} {center_y - arc:.2f} "
+            f"{center_x + radius:.2f} {center_y:.2f} c S",
+        ))
+
+    def add_brick_forms(self, colors):
+        """Registers bricks of colors (in this order) as form XObjects, already registered colors are skipped"""
+        size = _PDF_FORMATS[self.pdf_format]["small_brick_size"] * self.k
+        for color in colors:
+            if color not in self.forms:
+                # border is drawn outside of the brick too
+                self.add_form(color, (-self.line_width * self.k, -size - self.line_width * self.k,
+                                      size + self.line_width * self.k, self.line_width * self.k), self.brick_swatch(color))
+
     def small_brick(self, position_x, position_y, color):
-        """Adds a brick to the page"""
-        self.set_fill_color(*color)
-        self.set_xy(position_x, position_y)
-        self.cell(_PDF_FORMATS[self.pdf_format]["small_brick_size"], _PDF_FORMATS[self.pdf_format]["small_brick_size"], fill=True, border=1)
-        self.ellipse(position_x + _PDF_FORMATS[self.pdf_format]["small_brick_ellipsis_pos"],
-                     position_y + _PDF_FORMATS[self.pdf_format]["small_brick_ellipsis_pos"],
-                     _PDF_FORMATS[self.pdf_format]["small_brick_ellipsis_size"],
-                     _PDF_FORMATS[self.pdf_format]["small_brick_ellipsis_size"])
+        """Adds a brick to the page, every color is drawn once as a form XObject and then reused"""
+        self.add_brick_forms((color,))
+        self.use_form(color, position_x, position_y)
 
     def abort(self):
         """Stops creating PDF"""
@@ -0,0 +1,132 @@
+"""
+LePyMo LivePreview module
+
+This module contains LivePreview class.
+LivePreview renders scaled mosaic preview in a background thread whenever the palette is edited:
+a rough one (few rows) right away, then the exact one - the same as scaled mosaic image of a job -
+when no other edit comes for a while. Previews of older edits are cancelled.
+"""
+
+import os
+import threading
+import numpy as np
+from PIL import Image
+
+from modules.matcher import find_unique_colors, match_colors, _DEFAULT_METRIC
+from modules.mosaic import preview_sampling, _PREVIEW_HEIGHT
+from modules.palette import CompiledPalette
+
+# rows of the rough preview, it's ready in about 100 ms
+_ROUGH_HEIGHT = 48
+# seconds without edits before the exact preview is rendered
+_DEBOUNCE = 0.4
+# colors matched between checks for newer edits
+_CANCEL_CHUNK = 4096
+
+
+class LivePreview:
+    """
+    LivePreview class, renders previews of the latest palette in its own thread.
+    Every preview is passed to notify() as {"event_type": "preview", "image": ..., "exact": ..., "generation": ...},
+    image is None when the source image can't be opened.
+    """
+
+    def __init__(self, notify, match_cache=None):
+        """Init LivePreview class, match_cache (MatchCache or PaletteRemapper) may be shared with jobs"""
+        self.notify = notify
+        self.match_cache = match_cache
+        self.generation = 0
+        self.request = None
+        self.source = (None, None, None)
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, image_path, colors, metric=_DEFAULT_METRIC):
+        """Renders preview of image with palette colors, previews of earlier updates are cancelled"""
+        with self._condition:
+            self.generation += 1
+            self.request = None
+            if image_path and colors:
+                self.request = (self.generation, image_path, list(colors), metric)
+            self._condition.notify()
+        return self.generation
+
+    def close(self):
+        """Cancels current preview and stops the thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def stale(self, generation):
+        """Returns True when a newer preview was requested"""
+        return self._closed or generation != self.generation
+
+    def _run(self):
+        """Helper function, renders requested previews until LivePreview is closed"""
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or self.request is not None)
+                if self._closed:
+                    return
+                generation, image_path, colors, metric = self.request
+                self.request = None
+
+            try:
+                palette = CompiledPalette(colors)
+                self.render(generation, image_path, palette, metric, _ROUGH_HEIGHT)
+                with self._condition:
+                    # another edit soon after this one - its preview is rendered instead
+                    self._condition.wait_for(lambda: self.stale(generation), _DEBOUNCE)
+                self.render(generation, image_path, palette, metric, _PREVIEW_HEIGHT)
+            except Exception:  # pylint: disable=W0703
+                if not self.stale(generation):
+                    self.notify({"event_type": "preview", "image": None, "exact": True, "generation": generation})
+
+    def load(self, image_path):
+        """Helper function, returns RGB pixels of the image, the last decoded image is reused"""
+        modified = os.path.getmtime(image_path)
+        if self.source[:2] != (image_path, modified):
+            with Image.open(image_path) as image:
+                self.source = (image_path, modified, np.asarray(image.convert("RGB")))
+        return self.source[2]
+
+    def render(self, generation, image_path, palette, metric, scaled_height):  # pylint: disable=R0913
+        """Helper function, renders preview with scaled_height rows, nothing is posted when it's cancelled"""
+        if self.stale(generation):
+            return
+        pixels = self.load(image_path)
+        rows, columns = preview_sampling(pixels.shape[1], pixels.shape[0], scaled_height)
+        sampled = pixels[rows][:, columns]
+        colors, inverse = find_unique_colors(sampled)
+        indices = self.match(generation, palette, colors, metric)
+        if indices is None:
+            return
+
+        image = Image.fromarray(palette.srgb[indices[inverse]].reshape(sampled.shape))
+        if not self.stale(generation):
+            self.notify({"event_type": "preview", "image": image, "exact": scaled_height == _PREVIEW_HEIGHT,
+                         "generation": generation})
+
+    def match(self, generation, palette, colors, metric):
+        """Helper function, returns palette index of every color, None when a newer preview was requested"""
+        if self.match_cache is not None:
+            indices = self.match_cache.lookup(palette, colors, metric)
+        else:
+            indices = np.full(len(colors), -1, dtype=np.intp)
+        missing = np.flatnonzero(indices < 0)
+        matched = 0
+        try:
+            for start in range(0, len(missing), _CANCEL_CHUNK):
+                if self.stale(generation):
+                    return None
+                chunk = missing[start:start + _CANCEL_CHUNK]
+                indices[chunk] = match_colors(colors[chunk], palette, metric=metric)
+                matched += len(chunk)
+        finally:
+            # colors matched before cancelling are reused by next previews and jobs
+            if self.match_cache is not None and matched:
+                self.match_cache.store(palette, colors[missing[:matched]], indices[missing[:matched]], metric)
+        return indices
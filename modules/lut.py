@@ -0,0 +1,110 @@
+"""
+LePyMo LUT module
+
+This module contains ColorLUT class.
+ColorLUT maps a quantized RGB cube to palette indices, it is stored on disk
+(keyed by the palette fingerprint and metric) and memory-mapped on later runs.
+"""
+
+import os
+import time
+from contextlib import closing
+import numpy as np
+
+from modules.difference import color_difference, _DEFAULT_METRIC
+from modules.matcher import iter_parallel_match_chunks, match_colors
+from modules.palette import color_coordinates
+from modules.utilities import _CACHE_DIR
+
+_LUT_SIZES = (32, 64, 256)
+
+
+class ColorLUT:
+    """ColorLUT class, nearest palette color for every cell of an RGB cube"""
+
+    def __init__(self, palette, size=64, cache_dir=None, metric=_DEFAULT_METRIC):
+        """Init ColorLUT class"""
+        if size not in _LUT_SIZES:
+            size = 64
+        self.palette = palette
+        self.metric = metric
+        self.size = size
+        self.shift = 8 - (size.bit_length() - 1)
+        self.dtype = np.uint8 if len(palette) <= 256 else np.uint16
+        self.path = (cache_dir or _CACHE_DIR / "lut") / f"{palette.fingerprint}_{metric}_{size}.npy"
+        self.table = None
+        self.build_time = 0.0
+
+    @property
+    def nbytes(self):
+        """Returns size of the table in bytes"""
+        return self.size ** 3 * np.dtype(self.dtype).itemsize
+
+    def cell_colors(self):
+        """Returns (R, G, B) color representing the center of each cube cell"""
+        values = (np.arange(self.size, dtype=np.uint16) << self.shift) + ((1 << self.shift) >> 1)
+        values = values.astype(np.uint8)
+        red, green, blue = np.meshgrid(values, values, values, indexing="ij")
+        return np.stack((red.ravel(), green.ravel(), blue.ravel()), axis=1)
+
+    def load(self):
+        """Memory-maps table stored on disk, returns False if there's no table for this palette"""
+        try:
+            table = np.load(self.path, mmap_mode="r")
+        except (OSError, ValueError):
+            return False
+        if table.shape != (self.size,) * 3 or table.dtype != self.dtype:
+            return False
+        self.table = table
+        return True
+
+    def iter_build(self, workers=None):
+        """Generator, builds the table and yields (done, total) cells after each chunk"""
+        start_time = time.perf_counter()
+        colors = self.cell_colors()
+        table = np.empty(len(colors), dtype=self.dtype)
+        done = 0
+        with closing(iter_parallel_match_chunks(colors, self.palette, workers, metric=self.metric)) as matches:
+            for start, indices in matches:
+                table[start:start + len(indices)] = indices
+                done += len(indices)
+                yield done, len(colors)
+
+        self.table = table.reshape((self.size,) * 3)
+        self.build_time = time.perf_counter() - start_time
+
+    def build(self, workers=None):
+        """Builds the table"""
+        for _ in self.iter_build(workers):
+            pass
+
+    def save(self):
+        """Stores the table on disk and memory-maps it"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_name(f"{self.path.stem}.{os.getpid()}.tmp.npy")
+        np.save(temp_path, self.table)
+        os.replace(temp_path, self.path)
+        self.load()
+
+    def lookup(self, colors):
+        """Returns an array with palette index for every (R, G, B) color"""
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3) >> self.shift
+        return self.table[colors[:, 0], colors[:, 1], colors[:, 2]]
+
+    def measure_error(self, colors):
+        """
+        Compares lookup with exact matching for given colors.
+        Returns mismatch rate and color difference (of the table metric) added by the table (mean and max).
+        """
+        colors = np.unique(np.asarray(colors, dtype=np.uint8).reshape(-1, 3), axis=0)
+        coordinates = color_coordinates(colors, self.metric)
+        palette_coordinates = self.palette.coordinates(self.metric)
+        exact = match_colors(colors, self.palette, metric=self.metric)
+        approximate = self.lookup(colors)
+        error = (color_difference(coordinates, palette_coordinates[approximate], self.metric)
+                 - color_difference(coordinates, palette_coordinates[exact], self.metric))
+        return {
+            "mismatch_rate": float(np.mean(exact != approximate)) if len(colors) else 0.0,
+            "mean_delta_e": float(np.mean(error)) if len(colors) else 0.0,
+            "max_delta_e": float(np.max(error)) if len(colors) else 0.0,
+        }
@@ -0,0 +1,178 @@
+"""
+LePyMo MatchCache module
+
+This module contains MatchCache class.
+MatchCache remembers matched colors between runs, keyed by (palette fingerprint, metric, RGB).
+Recently used entries live in memory (LRU with a size cap), entries are kept in SQLite up to another cap -
+colors of least recently used palettes are removed first.
+"""
+
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from modules.matcher import color_keys
+from modules.utilities import _CACHE_DIR
+
+_MATCH_CACHE_SIZE = 200000
+# colors kept on disk (about 100 bytes each), every edited palette adds its own colors
+_MATCH_DISK_SIZE = 2000000
+# SQLite limits amount of parameters in a single query
+_SQLITE_BATCH = 500
+
+
+class MatchCache:  # pylint: disable=R0902
+    """MatchCache class, memory LRU backed by an on-disk SQLite store"""
+
+    def __init__(self, max_size=_MATCH_CACHE_SIZE, path=None, max_disk_size=_MATCH_DISK_SIZE):
+        """Init MatchCache class"""
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self.path = path or _CACHE_DIR / "matches.sqlite3"
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS matches (fingerprint TEXT, metric TEXT, color INTEGER, "
+                                     "palette_index INTEGER, PRIMARY KEY (fingerprint, metric, color)) WITHOUT ROWID")
+            # last use and amount of stored colors of every palette
+            self._connection.execute("CREATE TABLE IF NOT EXISTS palettes (fingerprint TEXT, metric TEXT, used REAL, "
+                                     "colors INTEGER, PRIMARY KEY (fingerprint, metric))")
+            if self._connection.execute("SELECT 1 FROM palettes LIMIT 1").fetchone() is None:
+                # store written before palettes were counted
+                self._connection.execute("INSERT INTO palettes SELECT fingerprint, metric, 0, COUNT(*) FROM matches "
+                                         "GROUP BY fingerprint, metric")
+            self._connection.commit()
+        except (sqlite3.Error, OSError):
+            # cache still works, but only in memory
+            self._connection = None
+
+    def _remember(self, key, index):
+        """Helper function, adds entry to memory and evicts least recently used ones"""
+        self.entries[key] = index
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def lookup(self, palette, colors, metric):
+        """Returns palette index for every (R, G, B) color, -1 for colors which aren't cached"""
+        keys = color_keys(colors).tolist()
+        result = np.full(len(keys), -1, dtype=np.intp)
+        missing = {}
+        with self._lock:
+            for position, color in enumerate(keys):
+                index = self.entries.get((palette.fingerprint, metric, color))
+                if index is None:
+                    missing[color] = position
+                else:
+                    self.entries.move_to_end((palette.fingerprint, metric, color))
+                    result[position] = index
+                    self.hits += 1
+
+            if self._connection is not None and missing:
+                disk_hits = self.disk_hits
+                try:
+                    self._lookup_disk(palette.fingerprint, metric, missing, result)
+                    if self.disk_hits > disk_hits:
+                        self._touch(palette.fingerprint, metric)
+                        self._connection.commit()
+                except sqlite3.Error:
+                    # locked or damaged store - colors which weren't read are matched again
+                    self._rollback()
+
+            self.misses += len(missing)
+        return result
+
+    def _lookup_disk(self, fingerprint, metric, missing, result):
+        """Helper function, reads missing colors ({color: position}) from disk into result"""
+        missing_colors = list(missing)
+        for batch_start in range(0, len(missing_colors), _SQLITE_BATCH):
+            batch = missing_colors[batch_start:batch_start + _SQLITE_BATCH]
+            rows = self._connection.execute(
+                "SELECT color, palette_index FROM matches WHERE fingerprint = ? AND metric = ? "
+                f"AND color IN ({', '.join('?' * len(batch))})", [fingerprint, metric] + batch).fetchall()
+            for color, index in rows:
+                result[missing.pop(color)] = index
+                self._remember((fingerprint, metric, color), index)
+                self.hits += 1
+                self.disk_hits += 1
+
+    def _touch(self, fingerprint, metric, added=0):
+        """Helper function, marks palette as used now and adds amount of its newly stored colors"""
+        self._connection.execute("INSERT OR IGNORE INTO palettes VALUES (?, ?, 0, 0)", (fingerprint, metric))
+        self._connection.execute("UPDATE palettes SET used = ?, colors = colors + ? WHERE fingerprint = ? AND metric = ?",
+                                 (time.time(), added, fingerprint, metric))
+
+    def _evict_disk(self, fingerprint, metric):
+        """Helper function, removes colors of least recently used palettes until the store fits max_disk_size"""
+        total = self._connection.execute("SELECT COALESCE(SUM(colors), 0) FROM palettes").fetchone()[0]
+        oldest = self._connection.execute("SELECT fingerprint, metric, colors FROM palettes ORDER BY used").fetchall()
+        for old_fingerprint, old_metric, colors in oldest:
+            if total <= self.max_disk_size:
+                break
+            if (old_fingerprint, old_metric) == (fingerprint, metric):
+                # the palette just stored is kept
+                continue
+            self._connection.execute("DELETE FROM matches WHERE fingerprint = ? AND metric = ?",
+                                     (old_fingerprint, old_metric))
+            self._connection.execute("DELETE FROM palettes WHERE fingerprint = ? AND metric = ?",
+                                     (old_fingerprint, old_metric))
+            total -= colors
+            self.disk_evictions += colors
+
+    def store(self, palette, colors, indices, metric):
+        """Saves matched colors in memory and on disk"""
+        keys = color_keys(colors).tolist()
+        indices = np.asarray(indices).tolist()
+        with self._lock:
+            for color, index in zip(keys, indices):
+                self._remember((palette.fingerprint, metric, color), index)
+
+            if self._connection is not None and keys:
+                try:
+                    # matching is deterministic, a color stored before has the same index
+                    added = self._connection.executemany(
+                        "INSERT OR IGNORE INTO matches VALUES (?, ?, ?, ?)",
+                        ((palette.fingerprint, metric, color, index) for color, index in zip(keys, indices))).rowcount
+                    self._touch(palette.fingerprint, metric, added)
+                    self._evict_disk(palette.fingerprint, metric)
+                    self._connection.commit()
+                except sqlite3.Error:
+                    self._rollback()
+
+    def _rollback(self):
+        """Helper function, drops unfinished changes of the on-disk store"""
+        try:
+            self._connection.rollback()
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        """Returns cache counters"""
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "max_disk_size": self.max_disk_size,
+            "disk_evictions": self.disk_evictions,
+        }
+
+    def close(self):
+        """Closes on-disk store"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
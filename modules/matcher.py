@@ -0,0 +1,138 @@
+"""
+LePyMo Matcher module
+
+This module contains batched color matching functions.
+Colors are converted to the space of the metric (CIE Lab or sRGB) and compared to the compiled palette
+using vectorized color difference, CIEDE2000 by default, chunk by chunk.
+"""
+
+import os
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from modules.difference import color_difference, _DEFAULT_METRIC
+from modules.palette import CompiledPalette, color_coordinates
+
+# number of (color, palette color) pairs compared at once, keeps temporary arrays small
+_MATCH_CHUNK_PAIRS = 2 ** 18
+# palettes with at least this amount of colors are searched using PaletteIndex (CIEDE2000 only)
+_INDEX_MIN_COLORS = 48
+# smaller jobs (colors x palette colors) are matched in the current process, starting a pool costs more
+_POOL_MIN_PAIRS = 2 ** 22
+
+_POOL_PALETTE = None
+
+
+def distance_matrix(colors, palette_colors, metric=_DEFAULT_METRIC):
+    """Helper function, returns distances between every color and every palette color (in the space of metric)"""
+    return color_difference(colors[:, np.newaxis, :], palette_colors[np.newaxis, :, :], metric)
+
+
+def color_keys(colors):
+    """Helper function, packs (R, G, B) colors into 24-bit integers"""
+    colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+    return (colors[:, 0].astype(np.uint32) << 16) | (colors[:, 1].astype(np.uint32) << 8) | colors[:, 2]
+
+
+def find_unique_colors(pixels):
+    """
+    Helper function, collapses (R, G, B) pixels to unique colors.
+    Returns (colors, inverse) - pixels are equal to colors[inverse].
+    """
+    unique_keys, inverse = np.unique(color_keys(pixels), return_inverse=True)
+    colors = np.stack(((unique_keys >> 16) & 0xFF, (unique_keys >> 8) & 0xFF, unique_keys & 0xFF), axis=1)
+    return colors.astype(np.uint8), inverse.reshape(-1)
+
+
+def iter_match_chunks(colors, palette, chunk_size=None, metric=_DEFAULT_METRIC):
+    """
+    Generator, finds the closest palette color for every (R, G, B) color.
+    Palette is a CompiledPalette. Yields (start, indices) for each chunk - indices point to the palette.
+    """
+    colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+    if chunk_size is None:
+        chunk_size = max(1, _MATCH_CHUNK_PAIRS // max(1, len(palette)))
+
+    for start in range(0, len(colors), chunk_size):
+        chunk = color_coordinates(colors[start:start + chunk_size], metric)
+        if metric == "ciede2000" and len(palette) >= _INDEX_MIN_COLORS:
+            yield start, palette.index.match(chunk)
+        else:
+            # argmin picks the first of equally distant colors, just like min() did
+            yield start, np.argmin(distance_matrix(chunk, palette.coordinates(metric), metric), axis=1)
+
+
+def match_colors(colors, palette, chunk_size=None, metric=_DEFAULT_METRIC):
+    """Returns an array with index of the closest palette color for every color"""
+    colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+    result = np.empty(len(colors), dtype=np.intp)
+    for start, indices in iter_match_chunks(colors, palette, chunk_size, metric):
+        result[start:start + len(indices)] = indices
+    return result
+
+
+def _init_pool_worker(colors):
+    """Helper function, compiles palette once in every pool process"""
+    global _POOL_PALETTE  # pylint: disable=W0603
+    # Ctrl+C in a terminal reaches pool processes too, the job is aborted by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _POOL_PALETTE = CompiledPalette(colors)
+
+
+def _match_pool_chunk(start, colors, metric):
+    """Helper function, matches a single chunk in a pool process"""
+    return start, match_colors(colors, _POOL_PALETTE, metric=metric)
+
+
+class MatchPool:  # pylint: disable=R0903
+    """MatchPool class, process pool with palette compiled in every process, reusable between images"""
+
+    def __init__(self, palette, workers=None):
+        """Init MatchPool class"""
+        self.fingerprint = palette.fingerprint
+        self.workers = workers or os.cpu_count() or 1
+        # spawn - forking a process which runs GUI threads isn't safe
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=_init_pool_worker, initargs=(palette.colors,))
+
+    def close(self):
+        """Stops pool processes, pending chunks are cancelled"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_parallel_match_chunks(colors, palette, workers=None, chunk_size=None,  # pylint: disable=R0913
+                               pool=None, metric=_DEFAULT_METRIC):
+    """
+    Generator, same as iter_match_chunks but chunks are matched in a process pool.
+    Pool is a MatchPool created for the same palette, or it's created for this call only.
+    Chunks are yielded in order of completion. Closing the generator cancels pending chunks.
+    """
+    colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+    if chunk_size is None:
+        chunk_size = max(1, _MATCH_CHUNK_PAIRS // max(1, len(palette)))
+    if pool is not None and pool.fingerprint != palette.fingerprint:
+        pool = None
+    if workers is None:
+        workers = pool.workers if pool else os.cpu_count() or 1
+    if (workers <= 1 or len(colors) <= chunk_size
+            or (pool is None and len(colors) * len(palette) < _POOL_MIN_PAIRS)):
+        yield from iter_match_chunks(colors, palette, chunk_size, metric)
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        pool = MatchPool(palette, workers)
+    futures = []
+    try:
+        futures = [pool.executor.submit(_match_pool_chunk, start, colors[start:start + chunk_size], metric)
+                   for start in range(0, len(colors), chunk_size)]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        if own_pool:
+            pool.close()
+        else:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,218 @@
+"""
+LePyMo Mosaic module
+
+This module contains BrickRows, Mosaic, RowRuns and MosaicRows classes.
+Mosaic keeps a palette index of every brick (uint8 up to 256 colors, uint16 above)
+and the palette table, instead of (R, G, B) tuples.
+MosaicRows keeps runs of the same color only, it's collected strip by strip while streaming.
+"""
+
+import bisect
+from abc import ABC, abstractmethod
+import numpy as np
+from PIL import Image
+
+from modules.matcher import find_unique_colors
+
+_PREVIEW_HEIGHT = 400
+
+
+def index_dtype(palette_table):
+    """Helper function, returns the smallest index type for a palette table"""
+    return np.uint8 if len(palette_table) <= 256 else np.uint16
+
+
+def preview_sampling(width, height, scaled_height=_PREVIEW_HEIGHT):
+    """Helper function, returns source rows and columns of every scaled preview pixel"""
+    scale = scaled_height / height
+    scaled_width = max(1, int(scale * width))
+    rows = ((np.arange(scaled_height) + 0.5) * height / scaled_height).astype(np.intp)
+    columns = ((np.arange(scaled_width) + 0.5) * width / scaled_width).astype(np.intp)
+    return rows, columns
+
+
+class BrickRows(ABC):
+    """BrickRows class, rows of bricks described by runs of the same color, subclasses provide runs()"""
+
+    def __init__(self, width, height, palette_table):
+        """Init BrickRows class"""
+        self.palette_table = np.ascontiguousarray(palette_table, dtype=np.uint8).reshape(-1, 3)
+        self.width = width
+        self.height = height
+        self.colors = [tuple(color) for color in self.palette_table.tolist()]
+        self._runs = None
+        self._row_counts = None
+
+    @abstractmethod
+    def runs(self):
+        """
+        Returns runs of the same color in all rows.
+        Runs of row i are run_colors[run_offsets[i]:run_offsets[i + 1]] (and run_lengths).
+        """
+
+    def counts(self):
+        """Returns amount of bricks of every palette color"""
+        run_colors, run_lengths, _ = self.runs()
+        return np.bincount(run_colors, weights=run_lengths, minlength=len(self.palette_table)).astype(np.int64)
+
+    def row_runs(self, row):
+        """Returns (colors, lengths) of runs of the same color in a row, from left to right"""
+        run_colors, run_lengths, run_offsets = self.runs()
+        row_slice = slice(run_offsets[row], run_offsets[row + 1])
+        return run_colors[row_slice], run_lengths[row_slice]
+
+    def row_counts(self, row):  # pylint: disable=R0914
+        """Returns (colors, counts) of bricks in a row, colors in order of their first appearance in the row"""
+        if self._row_counts is None:
+            run_colors, run_lengths, run_offsets = self.runs()
+            run_rows = np.repeat(np.arange(self.height), np.diff(run_offsets))
+            keys = run_rows * len(self.palette_table) + run_colors
+            unique_keys, first_runs, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            totals = np.bincount(inverse.reshape(-1), weights=run_lengths).astype(np.int64)
+            order = np.argsort(first_runs)
+            count_offsets = np.searchsorted(unique_keys[order] // len(self.palette_table), np.arange(self.height + 1))
+            self._row_counts = unique_keys[order] % len(self.palette_table), totals[order], count_offsets
+
+        count_colors, count_values, count_offsets = self._row_counts
+        row_slice = slice(count_offsets[row], count_offsets[row + 1])
+        return count_colors[row_slice], count_values[row_slice]
+
+    def rows(self, top, bottom):
+        """Returns RowRuns with rows from top to bottom (excluded)"""
+        run_colors, run_lengths, run_offsets = self.runs()
+        run_slice = slice(run_offsets[top], run_offsets[bottom])
+        return RowRuns(self.width, self.palette_table, run_colors[run_slice], run_lengths[run_slice],
+                       run_offsets[top:bottom + 1] - run_offsets[top])
+
+    def compact(self):
+        """Returns MosaicRows with used colors only, numbered in order of their first appearance"""
+        run_colors, run_lengths, run_offsets = self.runs()
+        used, first_runs = np.unique(run_colors, return_index=True)
+        order = np.argsort(first_runs)
+        rank = np.zeros(len(self.palette_table), dtype=np.intp)
+        rank[used[order]] = np.arange(len(order))
+        compacted = MosaicRows(self.width, self.palette_table[used[order]])
+        compacted.add_runs(rank[run_colors], run_lengths, run_offsets)
+        return compacted
+
+
+class Mosaic(BrickRows):
+    """Mosaic class, palette-indexed bricks"""
+
+    def __init__(self, indices, palette_table):
+        """Init Mosaic class, indices is a (height, width) array pointing to palette table rows"""
+        super().__init__(0, 0, palette_table)
+        self.indices = np.ascontiguousarray(indices, dtype=index_dtype(self.palette_table))
+        self.height, self.width = self.indices.shape
+
+    @classmethod
+    def from_image(cls, image):
+        """Creates Mosaic from a Pillow image, colors are numbered in order of their first appearance"""
+        colors, inverse = find_unique_colors(np.asarray(image.convert("RGB")))
+        return cls(inverse.reshape(image.size[1], image.size[0]), colors).compact()
+
+    def compact(self):
+        """Returns Mosaic with used colors only, numbered in order of their first appearance"""
+        used, first_bricks = np.unique(self.indices.ravel(), return_index=True)
+        order = np.argsort(first_bricks)
+        rank = np.zeros(len(self.palette_table), dtype=np.intp)
+        rank[used[order]] = np.arange(len(order))
+        return Mosaic(rank[self.indices], self.palette_table[used[order]])
+
+    def counts(self):
+        """Returns amount of bricks of every palette color"""
+        return np.bincount(self.indices.ravel(), minlength=len(self.palette_table))
+
+    def runs(self):
+        """Finds runs of the same color in all rows at once (computed once)"""
+        if self._runs is None:
+            flat = self.indices.ravel()
+            run_starts = np.ones(len(flat), dtype=bool)
+            run_starts[1:] = flat[1:] != flat[:-1]
+            run_starts[::self.width] = True
+            run_starts = np.flatnonzero(run_starts)
+            run_lengths = np.diff(np.append(run_starts, len(flat)))
+            run_offsets = np.searchsorted(run_starts // self.width, np.arange(self.height + 1))
+            self._runs = flat[run_starts], run_lengths, run_offsets
+        return self._runs
+
+    def to_array(self):
+        """Returns (height, width, 3) array of brick colors"""
+        return self.palette_table[self.indices]
+
+    def to_image(self):
+        """Returns Pillow image, "P" mode for up to 256 colors"""
+        if len(self.palette_table) > 256:
+            return Image.fromarray(self.to_array())
+        image = Image.fromarray(self.indices)
+        image.putpalette(self.palette_table.ravel().tolist())
+        return image
+
+    def to_preview(self, scaled_height=_PREVIEW_HEIGHT):
+        """Returns scaled preview (RGB Pillow image), every preview pixel takes color of the nearest brick"""
+        rows, columns = preview_sampling(self.width, self.height, scaled_height)
+        return Image.fromarray(self.palette_table[self.indices[rows][:, columns]])
+
+
+class RowRuns(BrickRows):
+    """RowRuns class, rows given by runs of the same color"""
+
+    def __init__(self, width, palette_table, run_colors, run_lengths, run_offsets):
+        """Init RowRuns class"""
+        super().__init__(width, len(run_offsets) - 1, palette_table)
+        self._runs = run_colors, run_lengths, run_offsets
+
+    def runs(self):
+        """Returns runs of the same color in all rows"""
+        return self._runs
+
+
+class MosaicRows(BrickRows):
+    """MosaicRows class, runs of the same color collected strip by strip"""
+
+    def __init__(self, width, palette_table):
+        """Init MosaicRows class"""
+        super().__init__(width, 0, palette_table)
+        self.strips = []
+        self.strip_tops = []
+
+    def add_rows(self, indices):
+        """Adds (rows, width) array of palette indices below already added rows"""
+        run_colors, run_lengths, run_offsets = Mosaic(indices, self.palette_table).runs()
+        # lengths never exceed the width
+        length_dtype = np.uint16 if self.width < 2 ** 16 else np.uint32
+        self.add_runs(run_colors, run_lengths.astype(length_dtype), run_offsets)
+
+    def add_runs(self, run_colors, run_lengths, run_offsets):
+        """Adds rows given by runs of the same color below already added rows"""
+        self.strip_tops.append(self.height)
+        self.strips.append(RowRuns(self.width, self.palette_table,
+                                   np.asarray(run_colors, dtype=index_dtype(self.palette_table)),
+                                   np.asarray(run_lengths), np.asarray(run_offsets)))
+        self.height += len(run_offsets) - 1
+        self._runs = None
+        self._row_counts = None
+
+    def runs(self):
+        """Returns runs of the same color in all rows, joined from all strips"""
+        if self._runs is None:
+            run_colors = np.concatenate([strip.runs()[0] for strip in self.strips])
+            run_lengths = np.concatenate([strip.runs()[1] for strip in self.strips])
+            row_sizes = np.concatenate([np.diff(strip.runs()[2]) for strip in self.strips])
+            self._runs = run_colors, run_lengths, np.concatenate(([0], np.cumsum(row_sizes)))
+        return self._runs
+
+    def strip_row(self, row):
+        """Helper function, returns (strip, row in strip) of a row"""
+        strip = bisect.bisect_right(self.strip_tops, row) - 1
+        return self.strips[strip], row - self.strip_tops[strip]
+
+    def row_runs(self, row):
+        """Returns (colors, lengths) of runs of the same color in a row, without joining strips"""
+        strip, strip_row = self.strip_row(row)
+        return strip.row_runs(strip_row)
+
+    def row_counts(self, row):
+        """Returns (colors, counts) of bricks in a row, without joining strips"""
+        strip, strip_row = self.strip_row(row)
+        return strip.row_counts(strip_row)
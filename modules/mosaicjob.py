@@ -0,0 +1,524 @@
+"""
+LePyMo MosaicJob module
+
+This module contains MosaicJob class.
+MosaicJob generates mosaic image and pdf of a single image without any GUI,
+progress is reported to a callback, so the same job runs in WorkerThread and in the command line.
+"""
+
+import os
+import pathlib
+import datetime
+import threading
+from contextlib import closing, nullcontext
+import numpy as np
+from PIL import Image
+from modules.utilities import sample_positions, _FILES_SUFFIXES
+from modules.jobreport import JobReport
+from modules.matcher import iter_parallel_match_chunks, find_unique_colors, _DEFAULT_METRIC
+from modules.lut import ColorLUT
+from modules.palette import CompiledPalette
+from modules.mosaic import Mosaic, MosaicRows, index_dtype
+from modules.pngwriter import PNGStreamWriter
+from modules.quantize import quantize_image, count_colors, measure_quantize_error, _DEFAULT_QUANTIZE_METHOD
+from modules.streaming import (StripMatcher, PreviewBuilder, StripPipeline, iter_image_strips, raw_strips_supported,
+                               sample_strip_colors, _STRIP_HEIGHT)
+
+
+class MosaicJob:  # pylint: disable=R0902
+    """
+    MosaicJob class, generates mosaic image and pdf of a single image.
+    Every event_data dict ({"event_type": "status_change" or "result", "status": ...}) is passed to notify(),
+    an aborted job passes {"event_type": "aborted", ...} instead of the result.
+    Times of job stages and counters are passed to report_hook() and written as JSON report when the job ends.
+    With job_cache, files of an identical job are copied and mosaic matched for another PDF format is reused.
+    With quantize, image is reduced to that amount of colors before matching, the report shows the added error.
+    """
+
+    def __init__(self, image_path, palette, nopdf, pdf_format, *, notify=None,  # pylint: disable=R0913,R0914
+                 output_prefix=None, lut_size=None, workers=None, match_cache=None, strip_height=None,
+                 pdf_workers=None, lut=None, match_pool=None, report_hook=None, job_cache=None,
+                 metric=_DEFAULT_METRIC, quantize=None, quantize_method=_DEFAULT_QUANTIZE_METHOD):
+        """
+        Init MosaicJob class, options after pdf_format are keyword-only.
+        Files are named output_prefix + suffix, run date in the current directory by default.
+        Compiled palette, match cache, job cache, lookup table and MatchPool may be shared between jobs.
+        Metric is a name of color difference from the registry in the difference module.
+        Quantize is the amount of colors (2 - 256) the image is reduced to by a Pillow quantizer, None keeps all colors.
+        """
+        self.notify = notify or (lambda event_data: None)
+        self.report_hook = report_hook or (lambda report: None)
+        self.report = JobReport()
+        self._abort = 0
+        # files of an aborted job are removed by whoever sees both the abort and the end of run()
+        self._finished = False
+        self._lock = threading.Lock()
+        self.image_path = image_path
+        self.palette = palette
+        self.pdf = False
+        self.nopdf = nopdf
+        self.pdf_format = pdf_format
+        self.output_prefix = output_prefix
+        self.lut_size = lut_size
+        self.metric = metric
+        self.quantize = quantize
+        self.quantize_method = quantize_method
+        self.quantize_stats = None
+        self.lut_stats = None
+        self.lut = lut
+        self.workers = workers
+        self.match_cache = match_cache
+        self.match_pool = match_pool
+        self.strip_height = strip_height
+        self.pdf_workers = pdf_workers
+        self.job_cache = job_cache
+        self.job_key = None
+        self.pending_indices = None
+        self.savers = []
+        self.save_error = None
+        self.run_date = False
+        self.summary = []
+
+    def run(self):
+        """Generates image and pdf, returns True when they're ready"""
+        result = False
+        try:
+            if self._abort == 0:
+                self.run_date = datetime.datetime.now().strftime("%d%m%Y_%H%M%S")
+                if self.output_prefix is None:
+                    self.output_prefix = self.run_date
+                if not isinstance(self.palette, CompiledPalette):
+                    self.palette = CompiledPalette(self.palette)
+
+                with self.report.stage("total"):
+                    result = self.generate()
+        finally:
+            with self._lock:
+                self._finished = True
+                aborted = self._abort == 1
+        if aborted:
+            # writers are closed or discarded by generate() in this thread, so its files can be removed
+            self.notify({"event_type": "aborted", "not_removed": self.remove_files()})
+            return False
+
+        # report is ready before the result is posted
+        self.write_report(result)
+        self.notify({"event_type": "status_change", "status": "Idle"})
+        if result:
+            self.notify({"event_type": "result", "status": True, "summary": "\n".join(self.summary)})
+        else:
+            self.notify({"event_type": "result", "status": False})
+        return result
+
+    def generate(self):
+        """Helper function, generates image and pdf, returns True when they're ready"""
+
+        # pylint: disable=R0911,R0912,R0915
+        try:
+            with self.report.stage("decode"):
+                src_image = Image.open(pathlib.Path(self.image_path))
+                # in streaming mode uncompressed images are read strip by strip, other ones are decoded whole
+                if not (self.strip_height and not self.quantize and raw_strips_supported(src_image)):
+                    src_image.load()
+        except:
+            src_image = False
+
+        if src_image and self.quantize and self._abort == 0:
+            self.notify({"event_type": "status_change", "status": f"Reducing image to {self.quantize} colors"})
+            try:
+                with self.report.stage("quantize"):
+                    src_image = self.quantize_image(src_image)
+            except:
+                src_image = False
+
+        if src_image and self._abort == 0:
+            try:
+                self.notify({"event_type": "status_change", "status": "Calculating pixels"})
+                image_width, image_height = src_image.size
+                self.report.add("pixels", image_width * image_height)
+                mosaic_name = self.output_prefix + "_mosaic.png"
+                mosaic_name_scaled = self.output_prefix + "_mosaic_scaled.png"
+                cached_indices = None
+                if self.job_cache is not None:
+                    with self.report.stage("job_cache"):
+                        if self.restore_job(src_image):
+                            return self._abort == 0
+                        cached_indices = self.job_cache.load_indices(self.job_key)
+                    if cached_indices is not None:
+                        self.report.add("job_cache_mosaic_hits")
+
+                if self.lut_size and self.lut is None and cached_indices is None:
+                    with self.report.stage("lut"):
+                        if not self.prepare_lut():
+                            return False
+
+                indices = None
+                if self.nopdf and not self.strip_height and cached_indices is None:
+                    with self.report.stage("match"):
+                        indices = self.match_image(src_image.convert("RGB"))
+                    if indices is None:
+                        return False
+
+                    self.notify({"event_type": "status_change", "status": "Generating image"})
+                    with self.report.stage("mosaic"):
+                        mosaic = Mosaic(indices.reshape(image_height, image_width), self.palette.srgb)
+                        mosaic_image = mosaic.to_image()
+                    indices = mosaic.indices
+                    with self.report.stage("preview_resize"):
+                        output_image = mosaic.to_preview()
+                    self.start_saver((mosaic_image, mosaic_name), (output_image, mosaic_name_scaled))
+                else:
+                    # PDF steps are built while next strips are still being matched
+                    built = self.build_strips(src_image, mosaic_name, mosaic_name_scaled, cached_indices)
+                    if built is None:
+                        return False
+                    output_image, indices = built
+
+                if self.lut and cached_indices is None:
+                    with self.report.stage("lut_error"):
+                        self.measure_lut(src_image)
+
+                if not self.nopdf and self._abort == 0:
+
+                    self.notify({"event_type": "status_change", "status": "Creating PDF main page"})
+                    with self.report.stage("main_page"):
+                        self.pdf.add_memory_image(self.pdf.image_scaled, output_image)
+                        self.pdf.main_page()
+                    if self._abort == 1:
+                        return False
+
+                    self.notify({"event_type": "status_change", "status": "Building PDF"})
+                    with self.report.stage("pdf_serialize"):
+                        self.pdf.output(self.output_prefix + "_mosaic_instructions.pdf", "F")
+                    self.summarize_pdf()
+                    self.pdf = False
+
+                for saver in self.savers:
+                    saver.join()
+                if self.save_error:
+                    raise self.save_error
+
+                if self.job_cache is not None and self._abort == 0:
+                    with self.report.stage("job_cache"):
+                        self.job_cache.store(self.job_key, self.output_prefix,
+                                             None if indices is cached_indices else indices,
+                                             None if self.nopdf else self.pdf_format)
+                    self.pending_indices = None
+                return self._abort == 0
+
+            except:
+                return False
+
+            finally:
+                if self.pdf:
+                    # unfinished PDF file is closed, so it can be removed
+                    self.pdf.discard()
+                if self.pending_indices is not None:
+                    self.job_cache.discard(self.pending_indices)
+                    self.pending_indices = None
+
+        return False
+
+    def quantize_image(self, src_image):
+        """Helper function, returns image reduced to quantize colors and measures error of the reduction"""
+        source = src_image.convert("RGB")
+        quantized = quantize_image(source, self.quantize, self.quantize_method)
+        self.quantize_stats = measure_quantize_error(source, quantized, self.palette, self.metric)
+        self.quantize_stats["source_colors"] = count_colors(source)
+        self.summary.append(f"Image reduced from {self.quantize_stats['source_colors']} to {self.quantize} colors, "
+                            f"mean color difference added: {self.quantize_stats['mean_delta_e']:.2f}")
+        return quantized
+
+    def quantize_report(self):
+        """
+        Helper function, returns quantize options, error and estimated time saved - exact matching of all
+        source colors in one process (timed on the error sample) minus quantizing and matching of the reduced image
+        """
+        stats = dict(self.quantize_stats)
+        stages = self.report.to_dict()["stages"]
+        spent = sum(stages.get(name, {}).get("wall_seconds", 0.0) for name in ("quantize", "match"))
+        exact_seconds = stats["exact_seconds_per_color"] * stats["source_colors"]
+        stats.update({"colors": self.quantize, "method": self.quantize_method,
+                      "estimated_exact_match_seconds": exact_seconds, "estimated_seconds_saved": exact_seconds - spent})
+        return stats
+
+    def restore_job(self, src_image):
+        """Helper function, copies files of an identical job from job cache, returns True when they're restored"""
+        lut_size = self.lut_size if self.lut is None else self.lut.size
+        self.job_key = self.job_cache.key(src_image, self.palette, self.metric, lut_size)
+        if self._abort == 1 or not self.job_cache.restore(self.job_key, self.output_prefix, None if self.nopdf else self.pdf_format):
+            return False
+
+        self.report.add("job_cache_hits")
+        self.summary.append("Files reused from an identical previous job")
+        return True
+
+    def prepare_lut(self):
+        """Helper function, loads or builds color lookup table, returns False when aborted"""
+        self.lut = ColorLUT(self.palette, self.lut_size, metric=self.metric)
+        if not self.lut.load():
+            with closing(self.lut.iter_build(self.workers)) as progress:
+                for done, total in progress:
+                    if self._abort == 1:
+                        return False
+
+                    self.notify({"event_type": "status_change", "status": f"Building color table {done} / {total}"})
+            self.lut.save()
+        return True
+
+    def measure_lut(self, src_image):
+        """Helper function, compares lookup table with exact matching on a sample of image pixels"""
+        self.lut_stats = self.lut.measure_error(sample_strip_colors(src_image, sample_positions(*src_image.size)))
+        self.summary.append(f"Color table {self.lut.size}^3 ({self.lut.nbytes // 1024} KB): "
+                            f"{100 * self.lut_stats['mismatch_rate']:.1f}% of sampled colors matched differently, "
+                            f"mean color difference added: {self.lut_stats['mean_delta_e']:.2f}")
+
+    def match_image(self, src_image):
+        """Helper function, returns palette index of every pixel, None when aborted"""
+        if self.lut:
+            return self.lut.lookup(np.asarray(src_image))
+
+        unique_colors, inverse = find_unique_colors(np.asarray(src_image))
+        if self.match_cache is not None:
+            color_indices = self.match_cache.lookup(self.palette, unique_colors, self.metric)
+        else:
+            color_indices = np.full(len(unique_colors), -1, dtype=np.intp)
+        # only colors which weren't matched in previous runs
+        missing = np.flatnonzero(color_indices < 0)
+        self.report.add("unique_colors", len(unique_colors))
+        self.report.add("match_cache_hits", len(unique_colors) - len(missing))
+        self.report.add("matched_colors", len(missing))
+        matched = 0
+        with closing(iter_parallel_match_chunks(unique_colors[missing], self.palette, self.workers,
+                                                pool=self.match_pool, metric=self.metric)) as matches:
+            # chunks may come from many processes, in any order
+            for start, chunk_indices in matches:
+                if self._abort == 1:
+                    return None
+
+                color_indices[missing[start:start + len(chunk_indices)]] = chunk_indices
+                matched += len(chunk_indices)
+                self.notify({"event_type": "status_change", "status": f"Calculating color {matched} / {len(missing)}"})
+
+        if self.match_cache is not None:
+            self.match_cache.store(self.palette, unique_colors[missing], color_indices[missing], self.metric)
+        return color_indices[inverse]
+
+    def iter_strips(self, src_image, mosaic_name, write_png):
+        """
+        Generator, matches image strip by strip and yields (top, palette indices of strip rows).
+        Mosaic PNG is written on the fly when write_png is True.
+        """
+        if self._abort == 1:
+            return
+        image_width, image_height = src_image.size
+        strip_matcher = StripMatcher(self.palette, self.workers, self.match_cache, self.lut, self.match_pool,
+                                     self.metric)
+        png_writer = nullcontext()
+        if write_png:
+            png_writer = PNGStreamWriter(mosaic_name, image_width, image_height, self.palette.srgb)
+        try:
+            with png_writer:
+                for top, strip in iter_image_strips(src_image, self.strip_height or _STRIP_HEIGHT):
+                    if self._abort == 1:
+                        return
+
+                    with self.report.stage("match"):
+                        strip_indices = strip_matcher.match(strip)
+                    if write_png:
+                        with self.report.stage("png_encode"):
+                            png_writer.write_rows(strip_indices)
+                    self.notify({"event_type": "status_change",
+                                 "status": f"Calculating row {top + len(strip)} / {image_height}"})
+                    yield top, strip_indices
+        finally:
+            strip_matcher.close()
+            if self.lut is None:
+                self.report.add("unique_colors", len(strip_matcher.known_keys))
+                self.report.add("match_cache_hits", strip_matcher.cache_hits)
+                self.report.add("matched_colors", strip_matcher.matched_colors)
+
+    def build_strips(self, src_image, mosaic_name, mosaic_name_scaled, cached_indices=None):  # pylint: disable=R0912,R0914,R0915
+        """
+        Helper function, builds PDF steps of matched rows while next strips are matched in another thread.
+        Rows of cached_indices (mosaic of a previous job) are used instead of matching.
+        PNG files are saved as soon as palette indices are final, before PDF steps are built in a process pool.
+        Returns (scaled preview, palette indices - PendingIndices when they're streamed to the job cache, or None),
+        None when aborted.
+        """
+        image_width, image_height = src_image.size
+        preview = PreviewBuilder(image_width, image_height, self.palette.srgb)
+        streaming = self.strip_height and cached_indices is None
+        indices = cached_indices
+        if self._abort == 1:
+            return None
+        if streaming and self.job_cache is not None:
+            # streamed indices go to the job cache through a file, they aren't kept in memory
+            self.pending_indices = self.job_cache.new_indices(self.job_key, (image_height, image_width),
+                                                              index_dtype(self.palette.srgb))
+            indices = self.pending_indices
+        elif indices is None and not streaming:
+            indices = np.empty((image_height, image_width), dtype=index_dtype(self.palette.srgb))
+        # steps are built in a process pool after matching, instead of one by one during matching
+        parallel_pdf = not self.nopdf and (self.pdf_workers or 1) > 1
+        # steps built one by one during matching would delay the PNG, so it's written on the fly too
+        write_png = streaming or (cached_indices is None and not self.nopdf and not parallel_pdf)
+        if cached_indices is None:
+            strips = self.iter_strips(src_image, mosaic_name, write_png)
+        else:
+            # mosaic of a previous job is final already
+            with self.report.stage("mosaic"):
+                self.start_saver((Mosaic(cached_indices, self.palette.srgb).to_image(), mosaic_name))
+            strips = ((top, cached_indices[top:top + _STRIP_HEIGHT]) for top in range(0, image_height, _STRIP_HEIGHT))
+        if not self.nopdf:
+            # fpdf is loaded by jobs which build PDF only
+            from modules.lepymopdf import LePyMoPDF  # pylint: disable=C0415
+            if not parallel_pdf:
+                # bounded queue, matching waits when PDF falls behind
+                strips = StripPipeline(strips, lambda: self._abort == 1)
+            self.pdf = LePyMoPDF(MosaicRows(image_width, self.palette.srgb), None, self.run_date, self.pdf_format)
+            # every step page goes to the file as soon as it's built
+            self.pdf.stream_to(self.output_prefix + "_mosaic_instructions.pdf")
+
+        with closing(strips):
+            for top, strip_indices in strips:
+                with self.report.stage("preview_resize"):
+                    preview.add_rows(top, strip_indices)
+                if self.pending_indices is not None:
+                    self.pending_indices.write_rows(strip_indices)
+                elif indices is not None and cached_indices is None:
+                    indices[top:top + len(strip_indices)] = strip_indices
+                if self.nopdf:
+                    continue
+
+                with self.report.stage("mosaic"):
+                    self.pdf.mosaic.add_rows(strip_indices)
+                if parallel_pdf:
+                    continue
+                for i in range(top, top + len(strip_indices)):
+                    self.notify({"event_type": "status_change", "status": f"Creating PDF page {i+1} / {image_height}"})
+                    with self.report.stage("step_render"):
+                        self.pdf.build_step(i)
+                    if self._abort == 1:
+                        return None
+
+        if self._abort == 1:
+            return None
+        images = ()
+        if not write_png and cached_indices is None:
+            with self.report.stage("mosaic"):
+                images = ((Mosaic(indices, self.palette.srgb).to_image(), mosaic_name),)
+        with self.report.stage("preview_resize"):
+            output_image = preview.to_image()
+        self.start_saver(*images, (output_image, mosaic_name_scaled))
+        if parallel_pdf:
+            with self.report.stage("step_render"):
+                if not self.build_parallel_steps():
+                    return None
+        return output_image, indices
+
+    def build_parallel_steps(self):
+        """Helper function, builds PDF steps of all rows in a process pool, returns False when aborted"""
+        image_height = self.pdf.mosaic.height
+        with closing(self.pdf.iter_parallel_steps(self.pdf_workers)) as progress:
+            for done in progress:
+                if self._abort == 1:
+                    return False
+
+                self.notify({"event_type": "status_change", "status": f"Creating PDF page {done} / {image_height}"})
+        return True
+
+    def summarize_pdf(self):
+        """Helper function, adds reuse of identical steps to the job summary"""
+        hits, misses = self.pdf.step_cache_stats()
+        self.report.add("step_cache_hits", hits)
+        self.report.add("step_cache_misses", misses)
+        self.report.add("pages", self.pdf.page)
+        if hits + misses:
+            self.summary.append(f"Steps reused from identical rows: {hits} / {hits + misses} "
+                                f"({100 * hits / (hits + misses):.1f}%)")
+
+    def start_saver(self, *images):
+        """Helper function, saves (image, filename) pairs in the background, PDF gets images straight from memory"""
+        saver = threading.Thread(target=self.save_images, args=images)
+        saver.start()
+        self.savers.append(saver)
+
+    def save_images(self, *images):
+        """Helper function, saves (image, filename) pairs as PNG files"""
+        try:
+            for image, filename in images:
+                if self._abort == 1:
+                    return
+                with self.report.stage("png_encode"):
+                    image.save(filename)
+        except Exception as error:  # pylint: disable=W0703
+            self.save_error = error
+
+    def write_report(self, result):
+        """Helper function, passes job report to report_hook and writes it next to the job files"""
+        report_name = self.output_prefix + "_report.json"
+        files = {filename: os.path.getsize(filename) for filename in self.output_files()
+                 if filename != report_name and os.path.exists(filename)}
+        self.report.add("bytes_written", sum(files.values()))
+        report = {
+            "image": str(self.image_path),
+            "run_date": self.run_date,
+            "output_prefix": self.output_prefix,
+            "result": result,
+            "palette_colors": len(self.palette),
+            "options": {"nopdf": bool(self.nopdf), "pdf_format": self.pdf_format, "metric": self.metric,
+                        "strip_height": self.strip_height,
+                        "lut_size": self.lut_size if self.lut is None else self.lut.size, "workers": self.workers,
+                        "pdf_workers": self.pdf_workers, "match_cache": self.match_cache is not None,
+                        "quantize": self.quantize, "quantize_method": self.quantize_method},
+            **self.report.to_dict(),
+            "files": files,
+        }
+        if self.quantize_stats is not None:
+            report["quantize"] = self.quantize_report()
+        if self.lut is not None:
+            # build time is 0 when the table was loaded from disk, error is measured when the image is matched
+            report["lut"] = {"size": self.lut.size, "bytes": self.lut.nbytes, "build_seconds": self.lut.build_time,
+                             **(self.lut_stats or {})}
+        self.report_hook(report)
+        try:
+            JobReport.save(report, report_name)
+        except OSError:
+            pass
+
+    def output_files(self):
+        """Returns names of files created by the job, none before it's started"""
+        if not self.run_date:
+            return []
+        return [self.output_prefix + suffix for suffix in _FILES_SUFFIXES]
+
+    def abort(self):
+        """
+        Stops the job without waiting for it. Its files are removed when the job ends (open files can't be removed
+        on Windows), then {"event_type": "aborted", "not_removed": names of files which couldn't be removed}
+        is passed to notify().
+        """
+        with self._lock:
+            self._abort = 1
+            finished = self._finished
+        pdf = self.pdf
+        if pdf:
+            pdf.abort()
+        if finished:
+            # nothing holds files of a job which has already ended
+            self.notify({"event_type": "aborted", "not_removed": self.remove_files()})
+
+    def remove_files(self):
+        """Helper function, removes files of the job, returns names of files which couldn't be removed"""
+        for saver in self.savers:
+            # files can't be removed until they're written
+            saver.join()
+        not_removed = []
+        for filename in self.output_files():
+            if os.path.exists(filename):
+                try:
+                    os.remove(filename)
+                except:
+                    not_removed.append(filename)
+        return not_removed
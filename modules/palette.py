@@ -0,0 +1,83 @@
+"""
+LePyMo Palette module
+
+This module contains CompiledPalette class and color space conversions.
+Palette is compiled once per run and reused by every matching call.
+"""
+
+import hashlib
+import numpy as np
+
+from modules.difference import _METRICS
+from modules.paletteindex import PaletteIndex
+
+# sRGB (D65) to CIE XYZ matrix, IEC 61966-2-1
+_SRGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def srgb_to_linear(colors):
+    """Helper function, converts 8-bit sRGB colors to linear RGB in range <0, 1>"""
+    colors = np.asarray(colors, dtype=np.float64) / 255
+    return np.where(colors <= 0.04045, colors / 12.92, ((colors + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_lab(colors):
+    """Helper function, converts linear RGB colors to CIE Lab (D65)"""
+    xyz = np.asarray(colors, dtype=np.float64) @ _SRGB_TO_XYZ.T / _D65_WHITE
+    xyz = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    lab = np.empty(xyz.shape, dtype=np.float64)
+    lab[..., 0] = 116 * xyz[..., 1] - 16
+    lab[..., 1] = 500 * (xyz[..., 0] - xyz[..., 1])
+    lab[..., 2] = 200 * (xyz[..., 1] - xyz[..., 2])
+    return lab
+
+
+def srgb_to_lab(colors):
+    """Helper function, converts 8-bit sRGB colors to CIE Lab (D65)"""
+    return linear_to_lab(srgb_to_linear(colors))
+
+
+def color_coordinates(colors, metric):
+    """Helper function, converts 8-bit sRGB colors to the space compared by metric"""
+    if _METRICS[metric]["space"] == "lab":
+        return srgb_to_lab(colors)
+    return np.asarray(colors, dtype=np.float64)
+
+
+class CompiledPalette:
+    """CompiledPalette class, keeps palette in sRGB, linear RGB and Lab"""
+
+    def __init__(self, colors):
+        """Init CompiledPalette class"""
+        self.colors = [tuple(int(cc) for cc in color) for color in colors]
+        self.srgb = np.ascontiguousarray(np.array(self.colors, dtype=np.uint8).reshape(-1, 3))
+        self.linear_rgb = np.ascontiguousarray(srgb_to_linear(self.srgb))
+        self.lab = np.ascontiguousarray(linear_to_lab(self.linear_rgb))
+        self.fingerprint = hashlib.sha1(self.srgb.tobytes()).hexdigest()
+        self._index = None
+
+    def coordinates(self, metric):
+        """Returns palette colors in the space compared by metric"""
+        if _METRICS[metric]["space"] == "lab":
+            return self.lab
+        return self.srgb.astype(np.float64)
+
+    @property
+    def index(self):
+        """Returns PaletteIndex of the palette, it's built on first use and reused later"""
+        if self._index is None:
+            self._index = PaletteIndex(self.lab)
+        return self._index
+
+    def __len__(self):
+        """Returns amount of colors in the palette"""
+        return len(self.colors)
+
+    def __getitem__(self, index):
+        """Returns palette color as (R, G, B) tuple"""
+        return self.colors[index]
@@ -0,0 +1,97 @@
+"""
+LePyMo PaletteIndex module
+
+This module contains PaletteIndex class.
+PaletteIndex finds the closest palette color without comparing every color with the whole palette.
+
+CIEDE2000 is not a metric, so Euclidean ball pruning (k-d tree) would not be exact.
+Instead the index uses a lower bound which always holds:
+    dE00 >= |L2 - L1| / SL, SL = 1 + 0.015 (L' - 50)^2 / sqrt(20 + (L' - 50)^2), L' = (L1 + L2) / 2
+(the chroma/hue part of dE00 is never negative because |RT| < 2).
+A coarse Lab grid gives a few Euclidean-nearest seeds for each color, the best seed distance
+limits the lightness slab of the palette (sorted by L), and exact CIEDE2000 runs only on
+palette colors whose bound does not exclude them. The result is the same as brute force.
+"""
+
+import numpy as np
+
+from modules.difference import delta_e_2000
+
+_GRID_CELLS = 16
+_GRID_SEEDS = 4
+# largest possible SL, for L' equal to 0 or 100
+_MAX_SL = 1 + 0.015 * 50 ** 2 / np.sqrt(20 + 50 ** 2)
+# keeps floating point rounding from excluding an equally distant color
+_BOUND_TOLERANCE = 1e-9
+
+
+def lightness_bound(lightness_1, lightness_2):
+    """Helper function, returns lower bound of CIEDE2000 based on lightness only"""
+    mean_lightness = (lightness_1 + lightness_2) / 2 - 50
+    weight = 1 + 0.015 * mean_lightness ** 2 / np.sqrt(20 + mean_lightness ** 2)
+    return np.abs(lightness_2 - lightness_1) / weight
+
+
+class PaletteIndex:
+    """PaletteIndex class, nearest palette color search in Lab with exact CIEDE2000 refinement"""
+
+    def __init__(self, palette_lab):
+        """Init PaletteIndex class"""
+        self.palette_lab = np.ascontiguousarray(palette_lab, dtype=np.float64).reshape(-1, 3)
+        self.order = np.argsort(self.palette_lab[:, 0], kind="stable")
+        self.sorted_lightness = self.palette_lab[self.order, 0]
+        self.grid_low = np.array([0.0, -128.0, -128.0])
+        self.grid_step = np.array([100.0, 256.0, 256.0]) / _GRID_CELLS
+        self.seeds = self._build_seeds()
+        self.evaluated = 0
+
+    def _build_seeds(self):
+        """Helper function, finds Euclidean-nearest palette colors for every grid cell center"""
+        cells = np.arange(_GRID_CELLS) + 0.5
+        grid = np.stack(np.meshgrid(cells, cells, cells, indexing="ij"), axis=-1).reshape(-1, 3)
+        centers = self.grid_low + grid * self.grid_step
+        distances = ((centers[:, np.newaxis, :] - self.palette_lab[np.newaxis, :, :]) ** 2).sum(axis=2)
+        seeds_count = min(_GRID_SEEDS, len(self.palette_lab))
+        seeds = np.argpartition(distances, seeds_count - 1, axis=1)[:, :seeds_count]
+        return seeds.reshape((_GRID_CELLS,) * 3 + (seeds_count,))
+
+    def candidates(self, colors_lab):
+        """Returns seed palette indices (n, seeds) for every Lab color"""
+        cells = np.floor((colors_lab - self.grid_low) / self.grid_step).astype(np.intp)
+        cells = np.clip(cells, 0, _GRID_CELLS - 1)
+        return self.seeds[cells[:, 0], cells[:, 1], cells[:, 2]]
+
+    def match(self, colors_lab):  # pylint: disable=R0914
+        """Returns an array with index of the closest (CIEDE2000) palette color for every Lab color"""
+        colors_lab = np.asarray(colors_lab, dtype=np.float64).reshape(-1, 3)
+        count = len(colors_lab)
+        if count == 0:
+            return np.empty(0, dtype=np.intp)
+
+        seeds = self.candidates(colors_lab)
+        seed_distances = delta_e_2000(colors_lab[:, np.newaxis, :], self.palette_lab[seeds])
+        limit = seed_distances.min(axis=1) * (1 + _BOUND_TOLERANCE) + _BOUND_TOLERANCE
+
+        # palette colors outside of the lightness slab can't beat the best seed
+        lightness = colors_lab[:, 0]
+        low = np.searchsorted(self.sorted_lightness, lightness - _MAX_SL * limit, side="left")
+        high = np.searchsorted(self.sorted_lightness, lightness + _MAX_SL * limit, side="right")
+        sizes = high - low
+        color_ids = np.repeat(np.arange(count), sizes)
+        offsets = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        palette_ids = self.order[np.repeat(low, sizes) + offsets]
+
+        bounds = lightness_bound(lightness[color_ids], self.palette_lab[palette_ids, 0])
+        keep = bounds <= limit[color_ids]
+        color_ids = color_ids[keep]
+        palette_ids = palette_ids[keep]
+        distances = delta_e_2000(colors_lab[color_ids], self.palette_lab[palette_ids])
+        self.evaluated += len(distances) + seeds.size
+
+        # the closest color, the lowest palette index wins a tie just like argmin does
+        ranking = np.lexsort((palette_ids, distances, color_ids))
+        first = np.ones(len(ranking), dtype=bool)
+        first[1:] = color_ids[ranking][1:] != color_ids[ranking][:-1]
+        result = np.empty(count, dtype=np.intp)
+        result[color_ids[ranking][first]] = palette_ids[ranking][first]
+        return result
@@ -0,0 +1,295 @@
+"""
+LePyMo PDFWriter module
+
+This module contains StreamingFPDF class.
+StreamingFPDF is FPDF which can write every finished page straight to the output file,
+so only offsets of written objects stay in memory and closing the document writes just
+fonts, images and the cross-reference table.
+
+Order of pages and a part of page content may be decided when the document is closed:
+page_order() gives the final order and every DEFERRED_MARK line is replaced with deferred_content().
+A written page keeps its deferred part as a separate content stream, written when the document is closed.
+
+Drawings repeated on many pages can be registered once as form XObjects (add_form()) and placed by name (use_form()).
+
+Pages may be built by other documents with the same fonts and form XObjects (in other processes too):
+fragment() returns their pages and add_fragment() appends them, the last page stays open in the new document.
+"""
+
+import zlib
+from fpdf import FPDF
+
+# PDF comment line, its content is known only when the document is closed
+DEFERRED_MARK = "%deferred"
+# FPDF attributes which decide how next content of a page is drawn
+_DRAWING_STATE = ("x", "y", "font_family", "font_style", "font_size_pt", "font_size", "current_font", "underline",
+                  "fill_color", "draw_color", "text_color", "color_flag", "line_width")
+
+
+class StreamingFPDF(FPDF):  # pylint: disable=R0902
+    """StreamingFPDF class, FPDF which writes pages to the output file as they are finished"""
+
+    def __init__(self, orientation="P", unit="mm", format="A4"):  # pylint: disable=W0622
+        """Init StreamingFPDF class"""
+        super().__init__(orientation, unit, format)
+        self.output_file = None
+        self.output_name = None
+        self.written = 0
+        self.page_objects = {}
+        self.deferred_objects = {}
+        self.forms = {}
+
+    def page_order(self):
+        """Returns pages in the order they are put in the document"""
+        return list(range(1, self.page + 1))
+
+    def deferred_content(self, page, number):  # pylint: disable=W0613
+        """Returns content which replaces DEFERRED_MARK of a page, number is its place in the document"""
+        return ""
+
+    def capture(self, draw):
+        """Returns PDF operators written by draw() instead of adding them to the document"""
+        buffer, state = self.buffer, self.state
+        self.buffer, self.state = "", 1
+        try:
+            draw()
+            return self.buffer
+        finally:
+            self.buffer, self.state = buffer, state
+
+    def add_form(self, name, bbox, content):
+        """Registers a form XObject, content is drawn in points from the origin and clipped to bbox (x1, y1, x2, y2)"""
+        self.forms[name] = {"i": len(self.forms) + 1, "bbox": bbox, "content": content}
+
+    def use_form(self, name, position_x, position_y):
+        """Draws a registered form XObject with its origin at a point of the page"""
+        self._out(f'q 1 0 0 1 {position_x * self.k:.2f} {(self.h - position_y) * self.k:.2f} cm '
+                  f'/X{self.forms[name]["i"]} Do Q')
+
+    def drawing_state(self):
+        """Returns state left by content drawn so far, see set_drawing_state()"""
+        return {name: getattr(self, name) for name in _DRAWING_STATE}
+
+    def set_drawing_state(self, state):
+        """Continues drawing in a state returned by drawing_state()"""
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def fragment(self, first_page):
+        """Returns pages from first_page on for add_fragment(), the last one is left open (without footer)"""
+        return {
+            "pages": [(self.pages[page], self.page_links.get(page, [])) for page in range(first_page, self.page + 1)],
+            "fonts": self.fonts,
+            "state": self.drawing_state(),
+        }
+
+    def add_fragment(self, fragment):
+        """Adds pages of fragment() after the current page, fonts have to be numbered the same in both documents"""
+        if self.state == 0:
+            self.open()
+        for key, font in fragment["fonts"].items():
+            if self.fonts.setdefault(key, font)["i"] != font["i"]:
+                self.error("Fragment uses different font numbers")
+        for number, (content, links) in enumerate(fragment["pages"]):
+            if self.page > 0:
+                if number == 0:
+                    self.in_footer = 1
+                    self.footer()
+                    self.in_footer = 0
+                self._endpage()
+            self._beginpage('')
+            self.pages[self.page] = content
+            if links:
+                self.page_links[self.page] = links
+        self.set_drawing_state(fragment["state"])
+
+    def stream_to(self, name):
+        """Starts writing pages to a file, call it before the first page is added"""
+        self.output_name = name
+        self.output_file = open(name, "wb")  # pylint: disable=R1732
+        self._putheader()
+        self._flush()
+
+    def discard(self):
+        """Closes unfinished output file"""
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+
+    def output(self, name='', dest=''):
+        """Finishes streamed document, other documents are written like FPDF does"""
+        if self.output_name is None:
+            return super().output(name, dest)
+        if self.state < 3:
+            self.close()
+        return ''
+
+    def _flush(self):
+        """Helper function, moves buffer to the output file"""
+        self.output_file.write(self.buffer.encode("latin1"))
+        self.written += len(self.buffer)
+        self.buffer = ""
+
+    def _newobj(self):
+        """Begins a new object, offsets count bytes which are already written"""
+        self.n += 1
+        self.offsets[self.n] = self.written + len(self.buffer)
+        self._out(str(self.n) + ' 0 obj')
+
+    def _putcontent(self, content, number=None):
+        """Helper function, writes a content stream object, number is given for a reserved object"""
+        data = zlib.compress(content.encode("latin1")) if self.compress else content
+        if number is None:
+            self._newobj()
+        else:
+            self.offsets[number] = self.written + len(self.buffer)
+            self._out(str(number) + ' 0 obj')
+        self._out('<<' + ('/Filter /FlateDecode ' if self.compress else '') + '/Length ' + str(len(data)) + '>>')
+        self._putstream(data)
+        self._out('endobj')
+
+    def _endpage(self):
+        """Ends page, streamed page is written right away"""
+        super()._endpage()
+        if self.output_file is None:
+            return
+
+        head, mark, tail = self.pages.pop(self.page).partition(DEFERRED_MARK + "\n")
+        contents = [self.n + 2]
+        if mark:
+            contents.append(self.n + 3)
+        if tail:
+            contents.append(contents[-1] + 1)
+
+        self.page_objects[self.page] = self.n + 1
+        self._newobj()
+        self._out('<</Type /Page')
+        self._out('/Parent 1 0 R')
+        if self.page in self.orientation_changes:
+            self._out(f'/MediaBox [0 0 {self.h_pt:.2f} {self.w_pt:.2f}]')
+        self._out('/Resources 2 0 R')
+        links = self.page_links.pop(self.page, [])
+        if links:
+            annots = '/Annots ['
+            for link in links:
+                if not isinstance(link[4], str):
+                    self.error("Internal links can't be used in streamed documents")
+                rect = f'{link[0]:.2f} {link[1]:.2f} {link[0] + link[2]:.2f} {link[1] - link[3]:.2f}'
+                annots += '<</Type /Annot /Subtype /Link /Rect [' + rect + '] /Border [0 0 0] '
+                annots += '/A <</S /URI /URI ' + self._textstring(link[4]) + '>>>>'
+            self._out(annots + ']')
+        if self.pdf_version > '1.3':
+            self._out('/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>')
+        if len(contents) == 1:
+            self._out('/Contents ' + str(contents[0]) + ' 0 R>>')
+        else:
+            self._out('/Contents [' + ' '.join(str(number) + ' 0 R' for number in contents) + ']>>')
+        self._out('endobj')
+
+        self._putcontent(head)
+        if mark:
+            # written when the document is closed
+            self.n += 1
+            self.deferred_objects[self.page] = self.n
+        if tail:
+            self._putcontent(tail)
+        self._flush()
+
+    def _putforms(self):
+        """Writes form XObjects"""
+        for form in self.forms.values():
+            data = zlib.compress(form["content"].encode("latin1")) if self.compress else form["content"]
+            self._newobj()
+            form["n"] = self.n
+            self._out('<</Type /XObject /Subtype /Form /BBox [' + ' '.join(f'{value:.2f}' for value in form["bbox"]) + ']')
+            self._out(('/Filter /FlateDecode ' if self.compress else '') + '/Length ' + str(len(data)) + '>>')
+            self._putstream(data)
+            self._out('endobj')
+
+    def _putxobjectdict(self):
+        """Writes names of images and form XObjects"""
+        super()._putxobjectdict()
+        for form in self.forms.values():
+            self._out('/X' + str(form["i"]) + ' ' + str(form["n"]) + ' 0 R')
+
+    def _putpages(self):
+        """Puts pages in their final order and replaces deferred marks"""
+        order = self.page_order()
+        self.pages = {number: self.pages[page] for number, page in enumerate(order, 1)}
+        self.page_links = {number: self.page_links[page] for number, page in enumerate(order, 1) if page in self.page_links}
+        for number, page in enumerate(order, 1):
+            if DEFERRED_MARK in self.pages[number]:
+                self.pages[number] = self.pages[number].replace(DEFERRED_MARK + "\n", self.deferred_content(page, number))
+        super()._putpages()
+
+    def _putresources(self):
+        """Writes fonts, images, form XObjects and the resource dictionary"""
+        self._putfonts()
+        self._putimages()
+        self._putforms()
+        self.offsets[2] = self.written + len(self.buffer)
+        self._out('2 0 obj')
+        self._out('<<')
+        self._putresourcedict()
+        self._out('>>')
+        self._out('endobj')
+
+    def _putcatalog(self):
+        """Writes catalog, streamed document opens on its first page instead of the first written one"""
+        if self.output_file is None:
+            super()._putcatalog()
+            return
+        catalog = self.capture(super()._putcatalog)
+        self.buffer += catalog.replace("[3 0 R ", f"[{self.page_objects[self.page_order()[0]]} 0 R ")
+
+    def _enddoc(self):
+        """Finishes document, streamed document gets its deferred content, page tree and cross-reference table"""
+        if self.output_file is None:
+            super()._enddoc()
+            return
+
+        order = self.page_order()
+        for number, page in enumerate(order, 1):
+            if page in self.deferred_objects:
+                self._putcontent(self.deferred_content(page, number), self.deferred_objects[page])
+
+        self.offsets[1] = self.written + len(self.buffer)
+        self._out('1 0 obj')
+        self._out('<</Type /Pages')
+        self._out('/Kids [' + ''.join(str(self.page_objects[page]) + ' 0 R ' for page in order) + ']')
+        self._out('/Count ' + str(len(order)))
+        if self.def_orientation == 'P':
+            self._out(f'/MediaBox [0 0 {self.fw_pt:.2f} {self.fh_pt:.2f}]')
+        else:
+            self._out(f'/MediaBox [0 0 {self.fh_pt:.2f} {self.fw_pt:.2f}]')
+        self._out('>>')
+        self._out('endobj')
+        self._putresources()
+
+        self._newobj()
+        self._out('<<')
+        self._putinfo()
+        self._out('>>')
+        self._out('endobj')
+        self._newobj()
+        self._out('<<')
+        self._putcatalog()
+        self._out('>>')
+        self._out('endobj')
+
+        xref = self.written + len(self.buffer)
+        self._out('xref')
+        self._out('0 ' + str(self.n + 1))
+        self._out('0000000000 65535 f ')
+        for number in range(1, self.n + 1):
+            self._out(f'{self.offsets[number]:010d} 00000 n ')
+        self._out('trailer')
+        self._out('<<')
+        self._puttrailer()
+        self._out('>>')
+        self._out('startxref')
+        self._out(xref)
+        self._out('%%EOF')
+        self._flush()
+        self.discard()
+        self.state = 3
@@ -0,0 +1,74 @@
+"""
+LePyMo PNGWriter module
+
+This module contains PNGStreamWriter class.
+PNGStreamWriter writes palette-indexed rows to a PNG file as they come,
+without keeping the whole image in memory.
+"""
+
+import struct
+import zlib
+import numpy as np
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# compressed data is written in IDAT chunks of about this size
+_IDAT_SIZE = 2 ** 16
+
+
+class PNGStreamWriter:
+    """PNGStreamWriter class, writes rows of palette indices to a PNG file"""
+
+    def __init__(self, path, width, height, palette_table):
+        """
+        Init PNGStreamWriter class.
+        Palette with up to 256 colors is stored as "P" mode image, bigger one as RGB image.
+        """
+        self.width = width
+        self.height = height
+        self.palette_table = np.ascontiguousarray(palette_table, dtype=np.uint8).reshape(-1, 3)
+        self.indexed = len(self.palette_table) <= 256
+        self.rows_written = 0
+        self._compressor = zlib.compressobj()
+        self._pending = b""
+        self._file = open(path, "wb")  # pylint: disable=R1732
+        self._file.write(_PNG_SIGNATURE)
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3 if self.indexed else 2, 0, 0, 0))
+        if self.indexed:
+            self._chunk(b"PLTE", self.palette_table.tobytes())
+
+    def __enter__(self):
+        """Returns PNGStreamWriter"""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Finishes PNG file, or just closes it when an exception was raised"""
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def _chunk(self, chunk_type, data):
+        """Helper function, writes a single PNG chunk"""
+        self._file.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+    def write_rows(self, indices):
+        """Writes (rows, width) array of palette indices"""
+        indices = np.asarray(indices)
+        pixels = indices.astype(np.uint8) if self.indexed else self.palette_table[indices].reshape(len(indices), -1)
+        # every row starts with filter type 0 (None)
+        rows = np.concatenate((np.zeros((len(indices), 1), dtype=np.uint8), pixels), axis=1)
+        self._pending += self._compressor.compress(rows.tobytes())
+        if len(self._pending) >= _IDAT_SIZE:
+            self._chunk(b"IDAT", self._pending)
+            self._pending = b""
+        self.rows_written += len(indices)
+
+    def close(self):
+        """Writes remaining data and closes file"""
+        if self._file.closed:
+            return
+        self._chunk(b"IDAT", self._pending + self._compressor.flush())
+        self._pending = b""
+        self._chunk(b"IEND", b"")
+        self._file.close()
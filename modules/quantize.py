@@ -0,0 +1,74 @@
+"""
+LePyMo Quantize module
+
+This module contains functions of the optional pre-pass which reduces source image colors
+with Pillow quantizers (median cut, fast octree or libimagequant when Pillow is built with it),
+so only those few colors are matched to the palette.
+Its error is measured on a sample of pixels against exact matching.
+"""
+
+import time
+import numpy as np
+from PIL import Image, features
+
+from modules.difference import color_difference, _DEFAULT_METRIC
+from modules.matcher import color_keys, match_colors
+from modules.palette import color_coordinates
+from modules.utilities import sample_colors, sample_positions, _ERROR_SAMPLE
+
+# module constants, Pillow 8 has no Image.Quantize and Image.Dither enums (newer Pillow adds constants dynamically)
+# pylint: disable=E1101
+_QUANTIZE_METHODS = {
+    "mediancut": Image.MEDIANCUT,
+    "octree": Image.FASTOCTREE,
+    "libimagequant": Image.LIBIMAGEQUANT,
+}
+_DEFAULT_QUANTIZE_METHOD = "mediancut"
+# Pillow quantizes to a "P" mode image
+_MAX_QUANTIZE_COLORS = 256
+
+
+def quantize_image(image, colors, method=_DEFAULT_QUANTIZE_METHOD):
+    """
+    Returns RGB image reduced to at most colors colors (2 - 256), without dithering.
+    libimagequant falls back to median cut when Pillow isn't built with it.
+    """
+    if method == "libimagequant" and not features.check_feature("libimagequant"):
+        method = _DEFAULT_QUANTIZE_METHOD
+    colors = min(max(2, colors), _MAX_QUANTIZE_COLORS)
+    return image.convert("RGB").quantize(colors, _QUANTIZE_METHODS[method], dither=Image.NONE).convert("RGB")
+
+
+def count_colors(image):
+    """Returns amount of unique colors of an RGB image"""
+    return len(np.unique(color_keys(np.asarray(image))))
+
+
+def measure_quantize_error(source, quantized, palette, metric=_DEFAULT_METRIC, sample=_ERROR_SAMPLE):  # pylint: disable=R0914
+    """
+    Compares matching of quantized image with exact matching of source image on a sample of pixels.
+    Returns mismatch rate, color difference added by quantizing (mean and max)
+    and seconds of exact matching of a single color (on the sample).
+    """
+    positions = sample_positions(source.width, source.height, sample)
+    source_colors = sample_colors(source, positions)
+    quantized_colors = sample_colors(quantized, positions)
+
+    # matched first, so the timed matching doesn't include compiling palette index
+    approximate = match_colors(quantized_colors, palette, metric=metric)
+    unique_colors, inverse = np.unique(source_colors, axis=0, return_inverse=True)
+    start = time.perf_counter()
+    exact = match_colors(unique_colors, palette, metric=metric)[inverse.reshape(-1)]
+    seconds_per_color = (time.perf_counter() - start) / max(1, len(unique_colors))
+
+    coordinates = color_coordinates(source_colors, metric)
+    palette_coordinates = palette.coordinates(metric)
+    error = (color_difference(coordinates, palette_coordinates[approximate], metric)
+             - color_difference(coordinates, palette_coordinates[exact], metric))
+    return {
+        "sample": sample,
+        "mismatch_rate": float(np.mean(exact != approximate)),
+        "mean_delta_e": float(np.mean(error)),
+        "max_delta_e": float(np.max(error)),
+        "exact_seconds_per_color": seconds_per_color,
+    }
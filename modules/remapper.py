@@ -0,0 +1,142 @@
+"""
+LePyMo Remapper module
+
+This module contains PaletteRemapper class.
+PaletteRemapper remembers the closest palette color (and its distance) of every matched color.
+When the palette is edited, the assignment is carried over instead of matching every color again:
+colors whose palette color was removed are matched again, other colors are compared with added colors only.
+"""
+
+import threading
+import numpy as np
+
+from modules.difference import color_difference
+from modules.matcher import color_keys, distance_matrix, match_colors, _MATCH_CHUNK_PAIRS
+from modules.palette import color_coordinates
+
+# remembered colors, colors matched later aren't remembered
+_REMAPPER_SIZE = 2 ** 20
+
+
+def key_colors(keys):
+    """Helper function, unpacks 24-bit integers into (R, G, B) colors"""
+    return np.stack(((keys >> 16) & 0xFF, (keys >> 8) & 0xFF, keys & 0xFF), axis=1).astype(np.uint8)
+
+
+class PaletteRemapper:  # pylint: disable=R0902
+    """
+    PaletteRemapper class, assignment of colors to the last used palette.
+    It's used like MatchCache (and passes colors it doesn't know to match_cache).
+    """
+
+    def __init__(self, match_cache=None, max_size=_REMAPPER_SIZE):
+        """Init PaletteRemapper class"""
+        self.match_cache = match_cache
+        self.max_size = max_size
+        self.palette = None
+        self.metric = None
+        # sorted color keys, palette index and distance of every remembered color
+        self.keys = np.empty(0, dtype=np.uint32)
+        self.indices = np.empty(0, dtype=np.intp)
+        self.distances = np.empty(0, dtype=np.float64)
+        self.hits = 0
+        self.remapped = 0
+        self.rematched = 0
+        self._lock = threading.Lock()
+
+    def _move_to(self, palette, metric):  # pylint: disable=R0914
+        """Helper function, carries the assignment over to another palette"""
+        if metric != self.metric or self.palette is None:
+            self.keys = np.empty(0, dtype=np.uint32)
+            self.indices = np.empty(0, dtype=np.intp)
+            self.distances = np.empty(0, dtype=np.float64)
+        elif palette.fingerprint != self.palette.fingerprint and len(self.keys):
+            # the first of duplicated palette colors wins, like in matching
+            positions = {}
+            for index, color in enumerate(palette.colors):
+                positions.setdefault(color, index)
+            old_colors = set(self.palette.colors)
+            added = np.array([index for color, index in positions.items() if color not in old_colors], dtype=np.intp)
+            self.indices = np.array([positions.get(color, -1) for color in self.palette.colors],
+                                    dtype=np.intp)[self.indices]
+
+            coordinates = color_coordinates(key_colors(self.keys), metric)
+            palette_coordinates = palette.coordinates(metric)
+            removed = np.flatnonzero(self.indices < 0)
+            kept = np.flatnonzero(self.indices >= 0)
+            if len(removed):
+                self.indices[removed] = match_colors(key_colors(self.keys[removed]), palette, metric=metric)
+                self.distances[removed] = color_difference(coordinates[removed],
+                                                           palette_coordinates[self.indices[removed]], metric)
+            if len(added):
+                chunk_size = max(1, _MATCH_CHUNK_PAIRS // len(added))
+                for start in range(0, len(kept), chunk_size):
+                    chunk = kept[start:start + chunk_size]
+                    distances = distance_matrix(coordinates[chunk], palette_coordinates[added], metric)
+                    closest = np.argmin(distances, axis=1)
+                    closest_distances = distances[np.arange(len(chunk)), closest]
+                    # equally distant colors - the one earlier in the palette wins
+                    better = (closest_distances < self.distances[chunk]) | (
+                        (closest_distances == self.distances[chunk]) & (added[closest] < self.indices[chunk]))
+                    self.indices[chunk[better]] = added[closest[better]]
+                    self.distances[chunk[better]] = closest_distances[better]
+            self.remapped += len(kept)
+            self.rematched += len(removed)
+        self.palette = palette
+        self.metric = metric
+
+    def _remember(self, palette, colors, indices):
+        """Helper function, adds matched colors and their distances to the assignment"""
+        keys = color_keys(colors)
+        if len(keys) == 0 or len(self.keys) >= self.max_size:
+            return
+        distances = color_difference(color_coordinates(colors, self.metric), palette.coordinates(self.metric)[indices],
+                                     self.metric)
+        keys, first = np.unique(np.concatenate((self.keys, keys)), return_index=True)
+        self.keys = keys
+        self.indices = np.concatenate((self.indices, indices))[first]
+        self.distances = np.concatenate((self.distances, distances))[first]
+
+    def lookup(self, palette, colors, metric):
+        """Returns palette index for every (R, G, B) color, -1 for colors which aren't known"""
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+        keys = color_keys(colors)
+        result = np.full(len(keys), -1, dtype=np.intp)
+        with self._lock:
+            self._move_to(palette, metric)
+            if len(self.keys):
+                positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+                known = self.keys[positions] == keys
+                result[known] = self.indices[positions[known]]
+                self.hits += int(known.sum())
+
+        missing = np.flatnonzero(result < 0)
+        if self.match_cache is not None and len(missing):
+            result[missing] = self.match_cache.lookup(palette, colors[missing], metric)
+            cached = missing[result[missing] >= 0]
+            with self._lock:
+                if palette.fingerprint == self.palette.fingerprint and metric == self.metric:
+                    self._remember(palette, colors[cached], result[cached])
+        return result
+
+    def store(self, palette, colors, indices, metric):
+        """Remembers matched colors and saves them in match_cache"""
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+        indices = np.asarray(indices, dtype=np.intp)
+        with self._lock:
+            if self.palette is not None and palette.fingerprint == self.palette.fingerprint and metric == self.metric:
+                self._remember(palette, colors, indices)
+        if self.match_cache is not None:
+            self.match_cache.store(palette, colors, indices, metric)
+
+    def stats(self):
+        """Returns remapper counters, and counters of match_cache"""
+        stats = {"size": len(self.keys), "hits": self.hits, "remapped": self.remapped, "rematched": self.rematched}
+        if self.match_cache is not None:
+            stats["match_cache"] = self.match_cache.stats()
+        return stats
+
+    def close(self):
+        """Closes match_cache"""
+        if self.match_cache is not None:
+            self.match_cache.close()
@@ -0,0 +1,249 @@
+"""
+LePyMo Streaming module
+
+This module contains StripMatcher, PreviewBuilder and StripPipeline classes.
+They are used to process an image strip by strip (horizontal bands of rows),
+so working memory depends on the strip size instead of the image size.
+StripPipeline lets strips be matched in one thread while another one already builds PDF steps.
+"""
+
+import queue
+import threading
+from contextlib import closing
+import numpy as np
+from PIL import Image
+
+from modules.matcher import (iter_parallel_match_chunks, find_unique_colors, color_keys, MatchPool,
+                             _DEFAULT_METRIC, _POOL_MIN_PAIRS)
+from modules.mosaic import index_dtype, preview_sampling, _PREVIEW_HEIGHT
+
+_STRIP_HEIGHT = 64
+# matched strips waiting for the PDF, matching pauses when the queue is full
+_PIPELINE_QUEUE_SIZE = 4
+# seconds between checks of abort while waiting for the queue
+_PIPELINE_POLL = 0.1
+
+
+def raw_strips_supported(image):
+    """
+    Helper function, returns True when rows of an image which isn't loaded yet can be read from its file strip by strip.
+    It works for uncompressed formats (BMP, PPM, TGA, TIFF) without a palette, other images are decoded whole.
+    """
+    # tile is emptied when the image is loaded
+    if getattr(image, "fp", None) is None or not image.tile:
+        return False
+    if image.mode in ("P", "PA"):
+        return False
+    for tile in image.tile:
+        codec_name, extents, _, args = tile
+        if codec_name != "raw" or extents[0] != 0 or extents[2] != image.width:
+            return False
+        if isinstance(args, tuple) and len(args) > 2 and args[2] not in (1, -1):
+            return False
+    return True
+
+
+def _raw_tile(image, tile):
+    """Helper function, returns (decoder arguments, bytes of a row in the file, row order) of a raw tile"""
+    args = tile[3] if isinstance(tile[3], tuple) else (tile[3],)
+    rawmode = args[0]
+    stride = args[1] if len(args) > 1 else 0
+    orientation = args[2] if len(args) > 2 else 1
+    if not stride:
+        # rows without padding - the decoder finishes a row of 8 pixels with (bits per pixel) bytes
+        row = Image.new(image.mode, (8, 1))
+        for pixel_bits in range(1, 65):
+            decoder = Image._getdecoder(image.mode, "raw", (rawmode, 0, 1))  # pylint: disable=W0212
+            decoder.setimage(row.im, (0, 0, 8, 1))
+            if decoder.decode(b"\0" * pixel_bits)[0] < 0:
+                break
+        stride = (pixel_bits * image.width + 7) // 8
+    return (rawmode, stride, orientation), stride, orientation
+
+
+def iter_raw_strips(image, strip_height=_STRIP_HEIGHT):  # pylint: disable=R0914
+    """Generator, same as iter_image_strips but only rows of the strip are read from the file and decoded"""
+    width, height = image.size
+    tiles = [(tile[1][1], tile[1][3], tile[2]) + _raw_tile(image, tile) for tile in image.tile]
+    for top in range(0, height, strip_height):
+        bottom = min(height, top + strip_height)
+        strip = Image.new(image.mode, (width, bottom - top))
+        for tile_top, tile_bottom, offset, args, stride, orientation in tiles:
+            first, last = max(top, tile_top), min(bottom, tile_bottom)
+            if first >= last:
+                continue
+            # bottom-up rows (BMP, TGA) are stored from the last one
+            row = first - tile_top if orientation == 1 else tile_bottom - last
+            image.fp.seek(offset + row * stride)
+            decoder = Image._getdecoder(image.mode, "raw", args)  # pylint: disable=W0212
+            decoder.setimage(strip.im, (0, first - top, width, last - top))
+            decoder.decode(image.fp.read((last - first) * stride))
+        yield top, np.asarray(strip.convert("RGB"))
+
+
+def iter_image_strips(image, strip_height=_STRIP_HEIGHT):
+    """
+    Generator, yields (top, strip) for every strip of image - strip is (rows, width, 3) RGB array.
+    Strips of uncompressed images which aren't loaded are read one by one, other images are decoded whole.
+    """
+    if raw_strips_supported(image):
+        yield from iter_raw_strips(image, strip_height)
+        return
+    width, height = image.size
+    for top in range(0, height, strip_height):
+        yield top, np.asarray(image.crop((0, top, width, min(height, top + strip_height))).convert("RGB"))
+
+
+def sample_strip_colors(image, positions):
+    """Helper function, returns (R, G, B) colors of image pixels at (x, y) positions, reading image strip by strip"""
+    positions = np.asarray(positions, dtype=np.intp).reshape(-1, 2)
+    colors = np.zeros((len(positions), 3), dtype=np.uint8)
+    for top, strip in iter_image_strips(image):
+        inside = np.flatnonzero((positions[:, 1] >= top) & (positions[:, 1] < top + len(strip)))
+        colors[inside] = strip[positions[inside, 1] - top, positions[inside, 0]]
+    return colors
+
+
+class StripMatcher:  # pylint: disable=R0902
+    """StripMatcher class, matches strips and remembers colors matched in previous strips"""
+
+    def __init__(self, palette, workers=None, match_cache=None, lut=None, pool=None,  # pylint: disable=R0913
+                 metric=_DEFAULT_METRIC):
+        """Init StripMatcher class, pool is a MatchPool shared with other jobs (it's not closed)"""
+        self.palette = palette
+        self.metric = metric
+        self.workers = workers
+        self.match_cache = match_cache
+        self.lut = lut
+        self.pool = pool
+        self.own_pool = pool is None
+        self.known_keys = np.empty(0, dtype=np.uint32)
+        self.known_indices = np.empty(0, dtype=np.intp)
+        # colors found in match cache and colors matched by this matcher
+        self.cache_hits = 0
+        self.matched_colors = 0
+
+    def match(self, pixels):
+        """Returns palette index for every pixel of a (rows, width, 3) strip"""
+        if self.lut is not None:
+            return self.lut.lookup(pixels).reshape(pixels.shape[:2])
+
+        colors, inverse = find_unique_colors(pixels)
+        keys = color_keys(colors)
+        known = np.zeros(len(keys), dtype=bool)
+        color_indices = np.full(len(keys), -1, dtype=np.intp)
+        if len(self.known_keys):
+            positions = np.minimum(np.searchsorted(self.known_keys, keys), len(self.known_keys) - 1)
+            known = self.known_keys[positions] == keys
+            color_indices[known] = self.known_indices[positions[known]]
+
+        missing = np.flatnonzero(~known)
+        if self.match_cache is not None and len(missing):
+            color_indices[missing] = self.match_cache.lookup(self.palette, colors[missing], self.metric)
+            newly_matched = missing[color_indices[missing] < 0]
+        else:
+            newly_matched = missing
+        self.cache_hits += len(missing) - len(newly_matched)
+        self.matched_colors += len(newly_matched)
+
+        if len(newly_matched) * len(self.palette) >= _POOL_MIN_PAIRS and self.pool is None and self.workers != 1:
+            self.pool = MatchPool(self.palette, self.workers)
+        with closing(iter_parallel_match_chunks(colors[newly_matched], self.palette, self.workers, pool=self.pool,
+                                                metric=self.metric)) as matches:
+            for start, chunk_indices in matches:
+                color_indices[newly_matched[start:start + len(chunk_indices)]] = chunk_indices
+        if self.match_cache is not None and len(newly_matched):
+            self.match_cache.store(self.palette, colors[newly_matched], color_indices[newly_matched], self.metric)
+
+        # known colors stay sorted by their keys
+        self.known_keys = np.concatenate((self.known_keys, keys[missing]))
+        self.known_indices = np.concatenate((self.known_indices, color_indices[missing]))
+        order = np.argsort(self.known_keys, kind="stable")
+        self.known_keys = self.known_keys[order]
+        self.known_indices = self.known_indices[order]
+        return color_indices[inverse].reshape(pixels.shape[:2])
+
+    def close(self):
+        """Stops matching processes"""
+        if self.pool is not None and self.own_pool:
+            self.pool.close()
+        self.pool = None
+
+
+class PreviewBuilder:
+    """PreviewBuilder class, collects scaled preview from strips - the same as Mosaic.to_preview()"""
+
+    def __init__(self, width, height, palette_table, scaled_height=_PREVIEW_HEIGHT):
+        """Init PreviewBuilder class"""
+        self.palette_table = np.ascontiguousarray(palette_table, dtype=np.uint8).reshape(-1, 3)
+        self.rows, self.columns = preview_sampling(width, height, scaled_height)
+        self.indices = np.zeros((len(self.rows), len(self.columns)), dtype=index_dtype(self.palette_table))
+
+    def add_rows(self, top, indices):
+        """Copies preview pixels which come from a strip starting at top row"""
+        selected = (self.rows >= top) & (self.rows < top + len(indices))
+        self.indices[selected] = np.asarray(indices)[self.rows[selected] - top][:, self.columns]
+
+    def to_image(self):
+        """Returns scaled preview (RGB Pillow image)"""
+        return Image.fromarray(self.palette_table[self.indices])
+
+
+class StripPipeline:
+    """
+    StripPipeline class, runs a strip generator in its own thread and hands its strips over a bounded queue.
+    Iterating StripPipeline yields the strips, an exception raised by the generator is raised there too.
+    """
+
+    _END = object()
+
+    def __init__(self, strips, aborted, size=_PIPELINE_QUEUE_SIZE):
+        """Init StripPipeline class, aborted is a function which returns True when the job is aborted"""
+        self.aborted = aborted
+        self.error = None
+        self._queue = queue.Queue(size)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(strips,))
+        self._thread.start()
+
+    def _produce(self, strips):
+        """Helper function, puts strips into the queue until generator ends or pipeline is closed"""
+        try:
+            for strip in strips:
+                if not self._put(strip):
+                    return
+        except Exception as error:  # pylint: disable=W0703
+            self.error = error
+        finally:
+            strips.close()
+        self._put(self._END)
+
+    def _put(self, item):
+        """Helper function, waits for free space in the queue, returns False when pipeline is closed"""
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=_PIPELINE_POLL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        """Yields strips as they are matched, stops when generator ends or the job is aborted"""
+        while True:
+            try:
+                item = self._queue.get(timeout=_PIPELINE_POLL)
+            except queue.Empty:
+                if self.aborted():
+                    return
+                continue
+            if item is self._END:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def close(self):
+        """Stops generator thread and waits for it"""
+        self._closed.set()
+        self._thread.join()
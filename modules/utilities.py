@@ -5,10 +5,20 @@ This module contains common constants, functions and classes.
 """
 
 import re
-import wx
-from colour.difference import delta_E_CIE2000
+import csv
+import pathlib
+import numpy as np
 
-_FILES_SUFFIXES = ["_mosaic.png", "_mosaic_scaled.png", "_mosaic_instructions.pdf"]
+from modules.difference import color_difference, _DEFAULT_METRIC
+from modules.palette import color_coordinates
+
+_FILES_SUFFIXES = ["_mosaic.png", "_mosaic_scaled.png", "_mosaic_instructions.pdf", "_report.json"]
+
+_CACHE_DIR = pathlib.Path.home() / ".lepymo"
+
+# pixels compared with exact matching when error of an approximation (lookup table, quantizing) is measured
+_ERROR_SAMPLE = 2048
+_ERROR_SEED = 2024
 
 _PDF_FORMATS = {
     "A4": {
@@ -66,11 +76,6 @@ _PDF_FORMATS = {
 }
 
 
-def event_result(window, function, event_id):
-    """Define Result Event."""
-    window.Connect(-1, -1, event_id, function)
-
-
 def validate_color(color):
     """
     Helper function, returns True if color is a
@@ -104,19 +109,44 @@ def convert_hex_to_rgb(color):
     return tuple(int(i, 16) for i in color)
 
 
-def closest_pixel(pixel, temp, colors):
-    """Helper function, finds closest pixel color based on palette"""
+def read_palette_csv(csv_file_path):
+    """
+    Helper function, returns colors (R, G, B) from CSV file, in order of rows and without duplicates.
+    Each row is R;G;B or a HEX color in the first column, other rows are skipped.
+    """
+    colors = []
+    with open(csv_file_path, newline='', encoding='utf-8') as csv_file:
+        for row in csv.reader(csv_file, delimiter=';', quotechar='|'):
+            if len(row) != 3:
+                continue
+            if row[0].startswith('#'):
+                if not validate_hex_color(row[0]):
+                    continue
+                color_tuple = convert_hex_to_rgb(row[0].lstrip('#'))
+            else:
+                color_tuple = tuple(int(z) for z in row if z.isdigit())
+            if validate_color(color_tuple) and color_tuple not in colors:
+                colors.append(color_tuple)
+    return colors
+
+
+def closest_pixel(pixel, temp, palette, metric=_DEFAULT_METRIC):
+    """Helper function, finds closest pixel color based on compiled palette"""
     if pixel in temp:
         return temp[pixel]
-    temp[pixel] = min(colors, key=lambda func: delta_E_CIE2000(pixel, func))
+    difference = color_difference(color_coordinates(pixel, metric), palette.coordinates(metric), metric)
+    temp[pixel] = palette[int(np.argmin(difference))]
     return temp[pixel]
 
 
-class ResultEvent(wx.PyEvent):  # pylint: disable=R0903
-    """Simple event to send thread results"""
+def sample_colors(image, positions):
+    """Helper function, returns (R, G, B) colors of image pixels at (x, y) positions"""
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+    return np.array([image.getpixel(position)[:3] for position in positions], dtype=np.uint8).reshape(-1, 3)
+
 
-    def __init__(self, event_id, data):
-        """Init Result Event."""
-        wx.PyEvent.__init__(self)
-        self.SetEventType(event_id)
-        self.data = data
+def sample_positions(width, height, sample=_ERROR_SAMPLE):
+    """Helper function, returns the same random (x, y) pixel positions for every image size"""
+    rng = np.random.default_rng(_ERROR_SEED)
+    return list(zip(rng.integers(0, width, sample).tolist(), rng.integers(0, height, sample).tolist()))
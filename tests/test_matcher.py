@@ -0,0 +1,46 @@
+"""
+LePyMo Matcher tests
+
+Batched matching (PaletteIndex for CIEDE2000 palettes of at least 48 colors) is compared
+with np.argmin of the full distance matrix.
+"""
+
+import numpy as np
+import pytest
+
+from modules.difference import _METRICS
+from modules.matcher import distance_matrix, match_colors
+from modules.palette import CompiledPalette, color_coordinates
+
+
+def random_colors(rng, amount):
+    """Helper function, returns amount of random (R, G, B) colors"""
+    return rng.integers(0, 256, (amount, 3), dtype=np.uint8)
+
+
+def full_match(colors, palette, metric):
+    """Helper function, returns index of the closest palette color using the whole distance matrix"""
+    return np.argmin(distance_matrix(color_coordinates(colors, metric), palette.coordinates(metric), metric), axis=1)
+
+
+@pytest.mark.parametrize("metric", sorted(_METRICS))
+@pytest.mark.parametrize("palette_size", [10, 47, 48, 150, 300])
+def test_match_colors_equals_full_distance_matrix(metric, palette_size):
+    """Every color gets the palette color with the smallest distance"""
+    rng = np.random.default_rng(palette_size)
+    palette = CompiledPalette(random_colors(rng, palette_size))
+    # palette colors themselves are matched too
+    colors = np.concatenate((random_colors(rng, 5000), palette.srgb))
+
+    np.testing.assert_array_equal(match_colors(colors, palette, metric=metric), full_match(colors, palette, metric))
+
+
+@pytest.mark.parametrize("metric", ["ciede2000", "redmean"])
+def test_match_colors_chunks(metric):
+    """Result doesn't depend on chunk size"""
+    rng = np.random.default_rng(1)
+    palette = CompiledPalette(random_colors(rng, 64))
+    colors = random_colors(rng, 1000)
+
+    np.testing.assert_array_equal(match_colors(colors, palette, chunk_size=7, metric=metric),
+                                  full_match(colors, palette, metric))
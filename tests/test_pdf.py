@@ -0,0 +1,36 @@
+"""
+LePyMo PDF tests
+
+PDF with steps built in a process pool is compared with the one built step by step.
+"""
+
+import re
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.mosaicjob import MosaicJob
+
+
+def build_pdf(image_path, palette, output_prefix, pdf_workers, strip_height):
+    """Helper function, runs a job and returns its PDF without the creation date"""
+    job = MosaicJob(str(image_path), palette, False, "A4", output_prefix=str(output_prefix),
+                    pdf_workers=pdf_workers, strip_height=strip_height)
+    assert job.run()
+    with open(f"{output_prefix}_mosaic_instructions.pdf", "rb") as pdf_file:
+        return re.sub(rb"/CreationDate \([^)]*\)", b"", pdf_file.read())
+
+
+@pytest.mark.parametrize("strip_height", [None, 64])
+def test_parallel_pdf_equals_sequential(tmp_path, strip_height):
+    """Pages, forms and objects are the same, steps are built in pool when the image has enough rows"""
+    rng = np.random.default_rng(0)
+    # repeated rows, so some steps are reused from identical rows
+    rows = rng.integers(0, 256, (100, 40, 3), dtype=np.uint8)
+    image_path = tmp_path / "image.png"
+    Image.fromarray(rows[rng.integers(0, len(rows), 300)]).save(image_path)
+    palette = [tuple(int(cc) for cc in color) for color in rng.integers(0, 256, (20, 3))]
+
+    sequential = build_pdf(image_path, palette, tmp_path / "sequential", 1, strip_height)
+    parallel = build_pdf(image_path, palette, tmp_path / "parallel", 2, strip_height)
+    assert parallel == sequential
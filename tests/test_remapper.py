@@ -0,0 +1,39 @@
+"""
+LePyMo Remapper tests
+
+Assignment carried over by PaletteRemapper through random palette edits is compared with matching every color again.
+"""
+
+import numpy as np
+import pytest
+
+from modules.matcher import match_colors
+from modules.palette import CompiledPalette
+from modules.remapper import PaletteRemapper
+
+
+def edit_palette(rng, colors):
+    """Helper function, removes some colors of the palette and adds random ones at random positions"""
+    colors = [color for color in colors if rng.random() > 0.2]
+    for _ in range(rng.integers(0, 8)):
+        colors.insert(int(rng.integers(0, len(colors) + 1)), tuple(int(cc) for cc in rng.integers(0, 256, 3)))
+    return colors
+
+
+@pytest.mark.parametrize("metric", ["ciede2000", "redmean", "euclidean"])
+@pytest.mark.parametrize("palette_size", [12, 60])
+def test_remapped_indices_equal_full_match(metric, palette_size):
+    """After every add / remove edit remembered colors get the same palette colors as a fresh match"""
+    rng = np.random.default_rng(palette_size)
+    colors = rng.integers(0, 256, (3000, 3), dtype=np.uint8)
+    palette_colors = [tuple(int(cc) for cc in color) for color in rng.integers(0, 256, (palette_size, 3))]
+    remapper = PaletteRemapper()
+    palette = CompiledPalette(palette_colors)
+    assert (remapper.lookup(palette, colors, metric) < 0).all()
+    remapper.store(palette, colors, match_colors(colors, palette, metric=metric), metric)
+
+    for _ in range(20):
+        palette_colors = edit_palette(rng, palette_colors)
+        palette = CompiledPalette(palette_colors)
+        np.testing.assert_array_equal(remapper.lookup(palette, colors, metric), match_colors(colors, palette, metric=metric))
+    assert remapper.stats()["remapped"] > 0